@@ -1,24 +1,40 @@
 import re
-import json
 import datetime
+import gzip
+import mimetypes
 import os
 import urllib
 import traceback
 from datetime import timedelta
-from time import sleep
+from functools import wraps
 
 import pymongo
+from pymongo.errors import BulkWriteError
 from flask.helpers import make_response
 from flask.templating import render_template
-from flask import Flask, redirect, url_for, jsonify, request
-from bson.objectid import ObjectId
+from flask import Flask, redirect, url_for, request
 from flask.wrappers import Response
+from markupsafe import Markup, escape
 from pytz import timezone
 
 from config import setup_logging, setup_db
-from lib import TimeFormat, convert_time_fields, TimePattern, convert_to_csv, TimePatternSimple, TimeFormatSimple, \
-    parse_user_accept_languages
+from lib import TimeFormat, TimePattern, TimePatternSimple, TimeFormatSimple, parse_user_accept_languages, iter_csv, \
+    format_cursor, parse_cursor, DatePattern, DateFormat
 from run_import import import_checkins, run_import_dec, run_import_suc
+import overview as overview_summary
+import assets
+import catalog
+import data_version
+import events
+import jobs
+import rollups
+import history
+import ingest
+import metrics
+import serialize
+import snapshot
+from serialize import JSONEncoder
+from cache import LruCache
 
 logger = setup_logging()
 db = setup_db()
@@ -29,17 +45,26 @@ tz_utc = timezone('UTC')
 tz_zurich = timezone("Europe/Zurich")
 
 max_distance = 20000
+max_radius = 500000
+max_nearest = 100
+default_search_limit = 20
+max_search_limit = 100
+max_batch_size = 500
+max_filter_locations = 200
 pattern_latlng = re.compile("(\d+\.\d+),(\d+\.\d+)")
 legacy_nof_stalls = 10
 
 
-class JSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, ObjectId):
-            return str(o)
-        elif isinstance(o, datetime.datetime):
-            return o.strftime(TimeFormat)
-        return json.JSONEncoder.default(self, o)
+def iter_json_array(items):
+    yield '['
+    first = True
+    for item in items:
+        if first:
+            yield serialize.dumps(item)
+            first = False
+        else:
+            yield ',' + serialize.dumps(item)
+    yield ']\n'
 
 
 class InvalidAPIUsage(Exception):
@@ -58,12 +83,43 @@ class InvalidAPIUsage(Exception):
         return rv
 
 app = Flask(__name__)
+metrics.instrument(app)
+
+
+encoded_responses = LruCache(max_size=256, ttl=600)
+
+
+def conditional(slot=None):
+    """ETag and Cache-Control for read endpoints, If-None-Match is answered with 304 before the endpoint runs."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = data_version.etag(db, slot)
+            key = (etag, request.full_path)
+            cached = encoded_responses.get(key)
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            elif cached:
+                response = Response(cached[0], mimetype=cached[1], headers=cached[2])
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                # the same url gives the same response until the data version changes, clients of all workers poll
+                headers = [(k, v) for k, v in response.headers if k.startswith('X-')]
+                encoded_responses.put(key, (response.get_data(), response.mimetype, headers))
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = data_version.max_age
+            return response
+        return wrapper
+    return decorator
 
 
 @app.errorhandler(InvalidAPIUsage)
 def handle_invalid_usage(error):
     logger.warn("Error, %s %s" % (error.to_dict(), traceback.format_exc()))
-    response = jsonify(error.to_dict())
+    response = serialize.response(error.to_dict())
     response.status_code = error.status_code
     return response
 
@@ -76,7 +132,8 @@ def index():
 
         preselected_supercharger = request.args.get('locationId', None)
         last_checkin = checkin_collection.find_one({'suc.locationId': preselected_supercharger},
-                                                   sort=[('checkin.time', pymongo.DESCENDING)])
+                                                   sort=[('checkin.time', pymongo.DESCENDING)])\
+            if preselected_supercharger else None
         if last_checkin:
             last_checkin = last_checkin['checkin']
         else:
@@ -84,23 +141,18 @@ def index():
 
         country = validate_str(request.args.get('country', ''), max_len=100)
 
-        countries = [s['_id'] for s in suc_collection.aggregate([
-            {'$match': {'type': 'supercharger'}},
-            {'$group': {'_id': '$country', 'count': {'$sum': 1}}},
-            {'$match': {'count': {'$gte': 4}}},
-            {'$sort': {'_id': 1}}
-        ])]
-
-        query = {'type': 'supercharger'}
-        if country:
-            if country == 'others':
-                query['country'] = {'$nin': countries}
-            else:
-                query['country'] = country
+        country_links = catalog.cached(db, 'countryLinks', lambda: render_template(
+            'form_countries.html', countries=catalog.countries(db)))
 
-        super_chargers = suc_collection\
-            .find(query, {'locationId': True, 'title': True, 'country': True, 'stalls': True})\
-            .sort([('country', pymongo.ASCENDING), ('title', pymongo.ASCENDING)])
+        super_chargers = catalog.super_chargers(db, country)
+        if super_chargers:
+            options = catalog.cached(db, ('superChargerOptions', country), lambda: render_template(
+                'form_options.html', superChargers=super_chargers))
+        else:
+            options = ''
+        if preselected_supercharger:
+            option = '<option value="%s">' % escape(preselected_supercharger)
+            options = options.replace(option, option[:-1] + ' selected>', 1)
 
         problems = [
             ('none', 'No problems / Keine Probleme'),
@@ -112,10 +164,9 @@ def index():
         stalls = sorted(generate_stall_names(legacy_nof_stalls))
 
         return render_template('form.html',
-                               countries=countries,
+                               countryLinks=Markup(country_links),
                                time=tz_utc.localize(datetime.datetime.utcnow()).astimezone(tz_zurich).strftime(TimeFormatSimple),
-                               superChargers=super_chargers,
-                               preselectedSupercharger=preselected_supercharger,
+                               superChargerOptions=Markup(options),
                                problems=problems,
                                stalls=stalls,
                                lastCheckin=last_checkin,
@@ -123,7 +174,37 @@ def index():
                                tffUserId=request.args.get('tffUserId', '')
         )
     else:
-        return app.send_static_file('index.html')
+        found = assets.variant(assets.page, request.accept_encodings)
+        if not found:
+            # assets were not built, e.g. during development
+            return app.send_static_file('index.html')
+        # the page names the current assets, clients revalidate it on every load
+        response = encoded(found, 'text/html')
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
+
+
+def encoded(variant, mimetype):
+    data, encoding = variant
+    response = Response(data, mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/assets/<name>')
+def asset(name):
+    """Fingerprinted assets, the content of a name never changes."""
+    found = assets.variant(name, request.accept_encodings)
+    if not found or name == assets.page:
+        raise InvalidAPIUsage("Not found", status_code=404)
+    response = encoded(found, mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/config.js')
@@ -137,46 +218,91 @@ def config():
     return Response(s, mimetype='application/javascript')
 
 
+def submit_import(name, run_import):
+    job_id = jobs.submit(db, name, lambda progress: run_import(suc_collection, progress))
+    if not job_id:
+        raise InvalidAPIUsage("Import already running", status_code=409)
+
+    response = serialize.response({'jobId': job_id, 'status': 'queued'})
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_status', job_id=job_id)
+    return response
+
+
 @app.route('/sucImport', methods=['POST'])
 def route_import_suc():
-    return jsonify(run_import_suc(suc_collection))
+    return submit_import('import:supercharger', run_import_suc)
 
 
 @app.route('/decImport', methods=['POST'])
 def route_import_dec():
-    return jsonify(run_import_dec(suc_collection))
+    return submit_import('import:destination_charger', run_import_dec)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.status(db, job_id)
+    if not job:
+        raise InvalidAPIUsage("Not found", status_code=404)
+    return serialize.response(job)
 
 
 @app.route('/lookup')
+@conditional()
 def lookup_query():
     query_param = request.args.get('query', None)
     if query_param and len(query_param) > 2:
         m = pattern_latlng.match(query_param)
         if m:
             lat, lng = float(m.group(1)), float(m.group(2))
-            q = get_query_coords(lat, lng)
-            q['type'] = 'supercharger'
+            k = request.args.get('k', None)
+            radius = request.args.get('radius', None)
+            if radius:
+                radius = min(validate_int(radius), max_radius)
+            elif not k:
+                radius = max_distance
+
+            index = catalog.spatial_index(db)
+            if k:
+                found = index.nearest(lat, lng, min(validate_int(k), max_nearest), radius)
+            else:
+                found = index.within(lat, lng, radius)
+            results = [dict(s, distance=round(distance)) for distance, s in found]
         else:
-            q = {'$or': [{'title': {'$regex': re.escape(query_param), '$options': '-i'}}, {'locationId': query_param}], 'type': 'supercharger'}
-        results = [c for c in suc_collection.find(q, {'raw': False, '_id': False, 'loc': False, 'type': False})]
+            limit = min(validate_int(request.args.get('limit', default_search_limit)), max_search_limit)
+            results = [dict(s) for s in catalog.search_index(db).search(query_param, limit)]
     else:
         results = []
 
+    last_checkins = overview_summary.last_checkins(db, [r['locationId'] for r in results]) if results else {}
     for r in results:
-        last_checkin = checkin_collection.find_one({'suc.locationId': r['locationId']}, sort=[('checkin.time', pymongo.DESCENDING)])
-        r['lastCheckin'] = last_checkin['checkin'] if last_checkin else None
-
-    return jsonify(results)
-
+        r['lastCheckin'] = last_checkins.get(r['locationId'], None)
 
-def get_query_coords(lat, lng):
-    return {'loc': {'$near': {'$geometry': {'type': "Point", 'coordinates': [lng, lat]}, '$maxDistance': max_distance,}}}
+    return serialize.response(results)
 
 
 def is_legacy():
     return request.args.get('legacy', False)
 
 
+# keyset pagination, _id breaks ties between checkins with the same time
+checkin_sort = [('checkin.time', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+
+def checkin_filter(text):
+    """Query and index hint of the checkins at locations whose title contains text, resolved through the catalog."""
+    if not text:
+        return {}, None
+    location_ids = sorted(set(catalog.title_index(db).matches(text)))
+    # the latest checkins of a few locations are merged from their index ranges, MongoDB merges at most 200 ranges
+    # (internalQueryMaxScansToExplode) and sorts in memory beyond, so those of many are read in time order instead
+    if len(location_ids) <= max_filter_locations:
+        hint = [('suc.locationId', pymongo.ASCENDING)] + checkin_sort
+    else:
+        hint = checkin_sort
+    return {'suc.locationId': {'$in': location_ids}}, hint
+
+
 @app.route('/checkin', methods=['GET', 'POST'])
 def checkin():
     if request.method == 'POST':
@@ -190,136 +316,191 @@ def checkin():
         else:
             client_data = request.get_json(force=True)
 
-        if not all(k in client_data for k in ('time', 'locationId', 'stalls',
-                                              'problem', 'affectedStalls',
-                                              #'charging', 'blocked', 'waiting',
-                                              'tffUserId', 'notes')):
-            raise InvalidAPIUsage("Invalid data received", status_code=400)
-
-        validated_data = {}
-        for k in ['stalls']:
-            validated_data[k] = validate_int(client_data[k])
-
-        validated_data['problem'] = validate_str(client_data['problem'], valid_values=['none', 'limitedPower', 'partialFailure', 'completeFailure', 'trafficDisruption'])
-        validated_data['affectedStalls'] = validate_list(client_data['affectedStalls'], generate_stall_names(validated_data['stalls']))
-
-        # optional values
-        for k in ['charging', 'blocked', 'waiting']:
-            if k in client_data and client_data[k]:
-                validated_data[k] = validate_int(client_data[k])
-            else:
-                validated_data[k] = None
-
-        validated_data['notes'] = validate_str(client_data['notes'])
-        validated_data['tffUserId'] = validate_str(client_data['tffUserId'])
-
-        location = validate_location(client_data['locationId'])
-
-        for k in ['charging', 'blocked']:
-            if validated_data[k] and validated_data[k] > location['stalls']:
-                raise InvalidAPIUsage("Charging/blocked cannot be larger than stalls", status_code=400)
-
-        submission = {
-            'suc': {
-                'locationId': location['locationId'],
-                'title': location['title'],
-                'country': location['country'],
-                'stalls': location['stalls'],
-                'loc': location['loc'],
-            },
-            'submitter': {
-                'userAgent': request.headers.get('User-Agent'),
-                'ip': request.remote_addr,
-                'time': tz_utc.localize(datetime.datetime.utcnow()),
-                'tffUserId': validated_data['tffUserId'],
-            },
-            'checkin': {
-                'time': validate_date(client_data['time']),
-                'charging': validated_data['charging'],
-                'blocked': validated_data['blocked'],
-                'waiting': validated_data['waiting'],
-
-                'problem': validated_data['problem'],
-                'affectedStalls': validated_data['affectedStalls'],
-
-                'notes': validated_data['notes'],
-            },
-        }
-
-        checkin_collection.insert(submission)
+        submission = validate_checkin(client_data)
+        if submit_checkins([submission]):
+            raise InvalidAPIUsage("Could not be stored", status_code=500)
 
         if is_legacy():
             s = "Checkin Nr. %d added, thank you." % checkin_collection.count()
             return redirect('/?legacy=true&msg=' + urllib.parse.quote_plus(s))
         else:
-            return jsonify({'error': None})
+            return serialize.response({'error': None})
     else:
         query_param = request.args.get('filter', None)
         format = request.args.get('format', None)
         limit = request.args.get('limit', None)
-
-        if query_param and len(query_param) > 0:
-            query = {'suc.title': {'$regex': re.escape(query_param), '$options': '-i'}}
-        else:
-            query = {}
-
-        res = checkin_collection.find(query, {'_id': False}).sort('checkin.time', -1)
+        after = request.args.get('after', None)
+
+        query, hint = checkin_filter(query_param)
+        if after:
+            t, object_id = validate_cursor(after)
+            query = {'$and': [query, {'$or': [{'checkin.time': {'$lt': t}},
+                                               {'checkin.time': t, '_id': {'$lt': object_id}}]}]}
+
+        res = checkin_collection.find(query).sort(checkin_sort)
+        if hint:
+            res = res.hint(hint)
+        headers = {}
         if limit:
-            res = res.limit(validate_int(limit))
-        results = [c for c in res]
+            limit = validate_int(limit)
+            res = res.limit(limit)
+            if limit > 0:
+                # the last item of this page is only known at the end of the stream, so look it up upfront
+                boundary = checkin_collection.find(query, {'checkin.time': True}).sort(checkin_sort)
+                if hint:
+                    boundary = boundary.hint(hint)
+                boundary = list(boundary.skip(limit - 1).limit(2))
+                if len(boundary) == 2:
+                    next_cursor = format_cursor(boundary[0]['checkin']['time'], boundary[0]['_id'])
+                    headers['X-Next-Cursor'] = next_cursor
+                    headers['Link'] = '<%s>; rel="next"' % url_for('checkin', filter=query_param, format=format, limit=limit, after=next_cursor)
+
+        def items():
+            for r in res:
+                del r['_id']
+                yield r
 
         if format == 'csv':
-            response = Response(convert_to_csv([{'locationId': r['suc']['locationId'], 'stalls': r['suc']['stalls'], 'time': r['checkin']['time'], 'charging': r['checkin']['charging'], 'blocked': r['checkin']['blocked'], 'waiting': r['checkin']['waiting']} for r in results]), mimetype='application/csv')
+            rows = ({'locationId': r['suc']['locationId'], 'stalls': r['suc']['stalls'], 'time': r['checkin']['time'], 'charging': r['checkin']['charging'], 'blocked': r['checkin']['blocked'], 'waiting': r['checkin']['waiting']} for r in items())
+            response = Response(iter_csv(rows), mimetype='application/csv', headers=headers)
             response.headers["Content-Disposition"] = "attachment; filename=checkins.csv"
             return response
+        elif format == 'ndjson':
+            return Response((serialize.dumps(r) + "\n" for r in items()), mimetype='application/x-ndjson', headers=headers)
         else:
-            return jsonify(results)
+            return Response(iter_json_array(items()), mimetype='application/json', headers=headers)
+
+
+def validate_checkin(client_data, locations=None):
+    """The checkin document to store for a submitted checkin, raises InvalidAPIUsage if it is not valid."""
+    if not isinstance(client_data, dict) or not all(k in client_data for k in ('time', 'locationId', 'stalls',
+                                                                               'problem', 'affectedStalls',
+                                                                               #'charging', 'blocked', 'waiting',
+                                                                               'tffUserId', 'notes')):
+        raise InvalidAPIUsage("Invalid data received", status_code=400)
+
+    validated_data = {}
+    for k in ['stalls']:
+        validated_data[k] = validate_int(client_data[k])
+
+    validated_data['problem'] = validate_str(client_data['problem'], valid_values=['none', 'limitedPower', 'partialFailure', 'completeFailure', 'trafficDisruption'])
+    validated_data['affectedStalls'] = validate_list(client_data['affectedStalls'], generate_stall_names(validated_data['stalls']))
+
+    # optional values
+    for k in ['charging', 'blocked', 'waiting']:
+        if k in client_data and client_data[k]:
+            validated_data[k] = validate_int(client_data[k])
+        else:
+            validated_data[k] = None
+
+    validated_data['notes'] = validate_str(client_data['notes'])
+    validated_data['tffUserId'] = validate_str(client_data['tffUserId'])
+
+    location = validate_location(client_data['locationId'], locations)
+
+    for k in ['charging', 'blocked']:
+        if validated_data[k] and validated_data[k] > location['stalls']:
+            raise InvalidAPIUsage("Charging/blocked cannot be larger than stalls", status_code=400)
+
+    submission = {
+        'suc': {
+            'locationId': location['locationId'],
+            'title': location['title'],
+            'country': location['country'],
+            'stalls': location['stalls'],
+            'loc': location['loc'],
+        },
+        'submitter': {
+            'userAgent': request.headers.get('User-Agent'),
+            'ip': request.remote_addr,
+            'time': tz_utc.localize(datetime.datetime.utcnow()),
+            'tffUserId': validated_data['tffUserId'],
+        },
+        'checkin': {
+            'time': validate_date(client_data['time']),
+            'charging': validated_data['charging'],
+            'blocked': validated_data['blocked'],
+            'waiting': validated_data['waiting'],
+
+            'problem': validated_data['problem'],
+            'affectedStalls': validated_data['affectedStalls'],
+
+            'notes': validated_data['notes'],
+        },
+    }
+    return submission
+
+
+def store_checkins(submissions):
+    """Insert checkins and feed the summaries with them, returns the indices of those which could not be inserted."""
+    failed = set()
+    try:
+        checkin_collection.insert_many(submissions, ordered=False)
+    except BulkWriteError as e:
+        failed = {error['index'] for error in e.details['writeErrors']}
+        logger.warn("Failed to store checkins, count=%d, errors=%s" % (len(failed), e.details['writeErrors'][:3]))
+
+    stored = [s for i, s in enumerate(submissions) if i not in failed]
+    if stored:
+        overview_summary.add_checkins(db, stored)
+        rollups.add_checkins(db, stored)
+        data_version.changed(db)
+        events.publish(db, events.checkin_events(stored))
+    return failed
+
+
+def submit_checkins(submissions):
+    try:
+        return ingest.submit(store_checkins, submissions)
+    except ingest.QueueFull:
+        raise InvalidAPIUsage("Too many checkins right now, try again later", status_code=503)
+    except ingest.FlushTimeout:
+        raise InvalidAPIUsage("Checkins are queued but not stored yet", status_code=503)
+
+
+@app.route('/checkinBatch', methods=['POST'])
+def checkin_batch():
+    """Several checkins in one request, e.g. queued offline reports, every item succeeds or fails on its own."""
+    items = request.get_json(force=True)
+    if not isinstance(items, list):
+        raise InvalidAPIUsage("Invalid data received", status_code=400)
+    if len(items) > max_batch_size:
+        raise InvalidAPIUsage("Too many checkins, at most %d per request" % max_batch_size, status_code=400)
+
+    locations = catalog.locations(db, [c['locationId'] for c in items
+                                       if isinstance(c, dict) and isinstance(c.get('locationId'), str)])
+    results = []
+    submissions = []
+    for client_data in items:
+        try:
+            submissions.append(validate_checkin(client_data, locations))
+            results.append({'error': None})
+        except InvalidAPIUsage as e:
+            results.append({'error': e.message})
+
+    if submissions:
+        valid = [i for i, r in enumerate(results) if r['error'] is None]
+        for index in submit_checkins(submissions):
+            results[valid[index]]['error'] = "Could not be stored"
+
+    return serialize.response({'imported': sum(1 for r in results if r['error'] is None), 'items': results})
 
 
 @app.route('/checkinImport', methods=['POST'])
 def checkin_import():
-    c = import_checkins(request.get_data(as_text=True))
-    return jsonify({'imported': c})
+    return serialize.response(import_checkins(request.get_data(as_text=True), suc_collection, checkin_collection))
 
 
 @app.route('/stats', methods=['GET'])
+@conditional()
 def stats():
-    checkins = {r['_id']: {'checkins': r['checkins'], 'utilization': r['utilization']}
-                for r in checkin_collection.aggregate([
-                    {'$group': {'_id': '$suc.country',
-                                'checkins': {'$sum': 1},
-                                'utilization': {'$avg': {'$divide': ['$checkin.charging', '$suc.stalls' ]}}}}
-                ])
-                }
-
-    countries = sorted(list(checkins.keys()))
-
-    sucs = {r['_id']: r['sucs']
-            for r in suc_collection.aggregate([
-                {'$match': {'type': 'supercharger', 'country': {'$in': countries}}},
-                {'$group': {'_id': '$country', 'sucs': {'$sum': 1}}}
-            ])
-            }
-
-    return jsonify([
-        {'country': c,
-         'sucs': sucs[c],
-         'checkins': checkins[c]['checkins'],
-         'utilization': checkins[c]['utilization']}
-        for c in countries
-    ])
+    return serialize.response(rollups.countries(db))
 
 
 @app.route('/stats/country/<country>', methods=['GET'])
+@conditional()
 def stats_country(country):
-    checkins = {r['_id']: {'checkins': r['checkins'], 'utilization': r['utilization']}
-                 for r in checkin_collection.aggregate([
-                    {'$match': {'suc.country': country}},
-                    {'$group': {'_id': '$suc.locationId',
-                                'checkins': {'$sum': 1},
-                                'utilization': {'$avg': {'$divide': ['$checkin.charging', '$suc.stalls']}}}}
-                ])
-                }
+    checkins = rollups.locations(db, country)
 
     def create_item(location):
         if location['locationId'] in checkins:
@@ -335,94 +516,160 @@ def stats_country(country):
             'utilization': c['utilization'],
         }
 
-    return jsonify([create_item(c) for c in suc_collection.find({'type': 'supercharger', 'country': country}).sort('title')])
+    return serialize.response([create_item(c) for c in suc_collection.find({'type': 'supercharger', 'country': country}).sort('title')])
 
 
 @app.route('/stats/superCharger/<location_id>', methods=['GET'])
 def stats_super_charger(location_id):
-    location = suc_collection.find_one({'locationId': location_id})
+    location = catalog.location(db, location_id)
     if not location:
         raise InvalidAPIUsage("Not found", status_code=404)
 
-    return jsonify({"title": location['title'], "country": location['country'], "items": [{
+    start = validate_time_param(request.args.get('from', None))
+    end = validate_time_param(request.args.get('to', None))
+    resolution = request.args.get('resolution', None)
+
+    if resolution:
+        validate_str(resolution, valid_values=list(history.resolutions.keys()))
+        return serialize.response({"title": location['title'], "country": location['country'], "resolution": resolution,
+                        "items": history.buckets(db, location_id, resolution, start, end)})
+
+    query = {'suc.locationId': location_id}
+    if start or end:
+        query['checkin.time'] = {}
+        if start:
+            query['checkin.time']['$gte'] = start
+        if end:
+            query['checkin.time']['$lt'] = end
+
+    return serialize.response({"title": location['title'], "country": location['country'], "items": [{
         'time': c['checkin']['time'],
         'stalls': c['suc']['stalls'],
         'charging': c['checkin']['charging'],
         'waiting': c['checkin']['waiting'],
         'blocked': c['checkin']['blocked'],
-    } for c in checkin_collection.find({'suc.locationId': location_id}).sort('checkin.time')]})
+    } for c in checkin_collection.find(query).sort('checkin.time')]})
 
 
 @app.route('/overview', methods=['GET',])
+@conditional(overview_summary.sweep_interval)
 def overview():
-    now_utc = tz_utc.localize(datetime.datetime.utcnow())
-    two_weeks_ago = now_utc - timedelta(days=14)
-
-    results = [{'locationId': c['_id'],
-                'title': c['title'],
-                'loc': {'lat': c['loc']['coordinates'][1], 'lng': c['loc']['coordinates'][0]},
-                'checkins': c['checkins'],
-                'utilization': c['utilization'],
-                'tffUserId': c['tffUserId'],
-                'lastCheckin': c['lastCheckin'],
-                'problem': c['problem'],
-                'affectedStalls': c['affectedStalls'],
-                'notes': c['notes'],
-                }
-               for c in checkin_collection.aggregate([
-            {'$match': {'checkin.time': {'$gt': two_weeks_ago}}},
-            {'$sort': {'checkin.time': 1}},
-            {'$group': {'_id': '$suc.locationId',
-                        'title': {'$last': '$suc.title'},
-                        'loc': {'$last': '$suc.loc'},
-                        'checkins': {'$sum': 1},
-                        'utilization': {'$avg': {'$divide': ['$checkin.charging', '$suc.stalls']}},
-                        'tffUserId': {'$last': '$submitter.tffUserId'},
-                        'lastCheckin': {'$last': '$checkin.time'},
-                        'problem': {'$last': '$checkin.problem'},
-                        'affectedStalls': {'$last': '$checkin.affectedStalls'},
-                        'notes': {'$last': '$checkin.notes'},
-                        }
-             }
-            ]
-        )
-    ]
+    # taken before reading, whatever is written meanwhile is part of the next delta
+    token = tz_utc.localize(datetime.datetime.utcnow()).strftime(TimeFormat)
+    since = request.args.get('since', None)
+    if since:
+        changed, removed = overview_summary.changes(db, validate_sync_token(since))
+        results = {'since': since, 'token': token, 'changed': changed, 'removed': removed}
+    else:
+        results = overview_summary.read(db)
 
     query_param_callback = request.args.get('callback', None)
     if query_param_callback:
-        return Response(
+        response = Response(
             query_param_callback + '(' + JSONEncoder().encode(results) + ');',
             mimetype='application/javascript')
     else:
-        return jsonify(results)
+        response = serialize.response(results)
+    response.headers['X-Sync-Token'] = token
+    return response
 
 
-@app.route('/metrics')
-def metrics():
-    results = [
-        'teslasuc_checkin_count ' + str(checkin_collection.count()),
-        'teslasuc_super_chargers_count ' + str(suc_collection.count({'type': 'supercharger'})),
-        'teslasuc_destination_chargers_count ' + str(suc_collection.count({'type': 'destination_charger'})),
-    ]
-
-    response = make_response("\n".join(results) + "\n")
-    response.headers["content-type"] = "text/plain"
+@app.route('/events')
+def event_stream():
+    """Server-sent events of stored checkins and changed locations, optionally of one country or some locations."""
+    country = request.args.get('country', None)
+    location_ids = set(filter(None, request.args.get('locationId', '').split(','))) or None
+    after = request.headers.get('Last-Event-ID', None) or request.args.get('after', None)
+    if after:
+        try:
+            after = events.parse_id(after)
+        except ValueError:
+            raise InvalidAPIUsage("Invalid event id", status_code=400)
+    else:
+        after = None
+
+    try:
+        stream = events.stream(db, serialize.dumps, country, location_ids, after)
+    except events.TooManyStreams:
+        return Response('retry: %d\n\n' % (events.retry_after * 1000), status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': str(events.retry_after), 'Cache-Control': 'no-cache'})
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def snapshot_version(s):
+    version = validate_int(s) if s else snapshot.latest_version(db)
+    if version is None:
+        # nothing was imported since snapshots were introduced
+        version = snapshot.generate(db)
+    return version
+
+
+def versioned(response, version, immutable):
+    response.headers['X-Snapshot-Version'] = str(version)
+    response.cache_control.public = True
+    if immutable:
+        # a version never changes, only the latest one moves
+        response.cache_control.max_age = 365 * 24 * 3600
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = data_version.max_age
     return response
 
 
-def validate_location(location_id):
-    location = suc_collection.find_one({'locationId': location_id})
+@app.route('/snapshot')
+def catalog_snapshot():
+    """The whole catalog as compact columns, of the given version or the latest one."""
+    version = snapshot_version(request.args.get('version', None))
+    stored = snapshot.load(db, version)
+    if not stored:
+        raise InvalidAPIUsage("Snapshot version not found", status_code=404)
+
+    etag = 'snapshot-%d' % version
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(stored['data'], mimetype='application/json', headers={'Content-Encoding': 'gzip'})
+    else:
+        response = Response(gzip.decompress(stored['data']), mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return versioned(response, version, 'version' in request.args)
+
+
+@app.route('/snapshot/diff')
+def catalog_snapshot_diff():
+    """Rows changed and removed between two snapshot versions, 404 if the older one is no longer kept."""
+    old_version = validate_int(request.args.get('from', ''))
+    new_version = snapshot_version(request.args.get('to', None))
+    changes = snapshot.diff(db, old_version, new_version)
+    if changes is None:
+        raise InvalidAPIUsage("Snapshot version not found", status_code=404)
+    return versioned(serialize.response(changes), new_version, 'to' in request.args)
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    body, content_type = metrics.render(db, catalog.type_counts)
+    return Response(body, content_type=content_type)
+
+
+def validate_location(location_id, locations=None):
+    if not isinstance(location_id, str):
+        raise InvalidAPIUsage("Invalid location", status_code=400)
+    location = catalog.location(db, location_id) if locations is None else locations.get(location_id)
     if not location:
         raise InvalidAPIUsage("Invalid location", status_code=400)
     return location
 
 
 def validate_int(s):
-    if isinstance(s, str) and not s:  # check for empty string, but s can also be an int when coming from json
+    # s can also be a number when coming from json, but not a bool, null, list or object
+    if isinstance(s, bool) or not isinstance(s, (int, float, str)) or (isinstance(s, str) and not s):
         raise InvalidAPIUsage("Invalid number", status_code=400)
     try:
         val = int(s)
-    except ValueError:
+    except (TypeError, ValueError, OverflowError):
         raise InvalidAPIUsage("Invalid number", status_code=400)
 
     if val < 0:
@@ -444,6 +691,8 @@ def validate_str(s, max_len=1000, valid_values=None):
 
 
 def validate_date(s):
+    if not isinstance(s, str):
+        raise InvalidAPIUsage("Invalid date", status_code=400)
     if TimePattern.match(s):
         d = datetime.datetime.strptime(s, TimeFormat)
         d = tz_utc.localize(d)
@@ -464,6 +713,33 @@ def validate_date(s):
     return d
 
 
+def validate_time_param(s):
+    """Optional time range parameter, either a full timestamp or a date, returned as naive UTC."""
+    if not s:
+        return None
+    if TimePattern.match(s):
+        return datetime.datetime.strptime(s, TimeFormat)
+    elif DatePattern.match(s):
+        return datetime.datetime.strptime(s, DateFormat)
+    raise InvalidAPIUsage("Invalid date", status_code=400)
+
+
+def validate_sync_token(s):
+    """The time of a sync token handed out by /overview, as UTC."""
+    try:
+        return tz_utc.localize(datetime.datetime.strptime(s, TimeFormat))
+    except ValueError:
+        raise InvalidAPIUsage("Invalid sync token", status_code=400)
+
+
+def validate_cursor(s):
+    try:
+        t, object_id = parse_cursor(s)
+    except ValueError:
+        raise InvalidAPIUsage("Invalid cursor", status_code=400)
+    return tz_utc.localize(t), object_id
+
+
 def validate_list(l, valid_entries):
     if not isinstance(l, list):
         raise InvalidAPIUsage("Value is not a list", status_code=400)
@@ -0,0 +1,122 @@
+"""Fingerprinted, precompressed copies of the files in static/, built by `python manage.py build-assets`.
+
+Every asset is written as <name>.<content hash><ext> next to its gzip and, if the brotli package is installed,
+brotli variant. References to /static/<name> inside the assets are rewritten to the fingerprinted names under
+/assets/, so app.js is built after the templates it loads and index.html last. index.html keeps its name, it is
+the only file which is not cached for good.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from config import setup_logging
+
+logger = setup_logging()
+
+source_dir = 'static'
+build_dir = os.getenv('TESLASUC_ASSETS_DIR', 'assets')
+extensions = ('.js', '.css', '.html')
+page = 'index.html'
+url_prefix = '/assets/'
+
+pattern_reference = re.compile(r'/static/([\w.-]+)')
+
+# variants by file name, read once per process
+_files = None
+
+
+def references(text):
+    return set(pattern_reference.findall(text))
+
+
+def rewrite(text, manifest):
+    return pattern_reference.sub(lambda m: url_prefix + manifest[m.group(1)] if m.group(1) in manifest else m.group(0),
+                                 text)
+
+
+def fingerprint(name, data):
+    stem, ext = os.path.splitext(name)
+    return '%s.%s%s' % (stem, hashlib.sha1(data).hexdigest()[:10], ext)
+
+
+def write(target, name, data):
+    with open(os.path.join(target, name), 'wb') as f:
+        f.write(data)
+    with open(os.path.join(target, name + '.gz'), 'wb') as f:
+        # without a timestamp the same content always gives the same file
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        with open(os.path.join(target, name + '.br'), 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def build(source=source_dir, target=build_dir):
+    """Write the fingerprinted assets and manifest.json to target, returns the manifest."""
+    texts = {}
+    for name in sorted(os.listdir(source)):
+        if os.path.splitext(name)[1] in extensions:
+            with open(os.path.join(source, name), encoding='utf-8') as f:
+                texts[name] = f.read()
+    os.makedirs(target, exist_ok=True)
+
+    # an asset is built once all assets it references have their final name
+    manifest = {}
+    pending = [name for name in texts if name != page]
+    while pending:
+        ready = [name for name in pending
+                 if all(r in manifest for r in references(texts[name]) if r in texts and r != name and r != page)]
+        if not ready:
+            raise ValueError("Circular references between %s" % ', '.join(pending))
+        for name in ready:
+            data = rewrite(texts[name], manifest).encode('utf-8')
+            manifest[name] = fingerprint(name, data)
+            write(target, manifest[name], data)
+            pending.remove(name)
+
+    if page in texts:
+        write(target, page, rewrite(texts[page], manifest).encode('utf-8'))
+    with open(os.path.join(target, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    logger.info("Built assets, count=%d, brotli=%s" % (len(manifest), brotli is not None))
+    return manifest
+
+
+def load(target=None):
+    """Variants of the built assets by name and encoding, empty if they were not built."""
+    target = target or build_dir
+    files = {}
+    if not os.path.exists(os.path.join(target, 'manifest.json')):
+        return files
+    for name in os.listdir(target):
+        if name == 'manifest.json':
+            continue
+        base, ext = os.path.splitext(name)
+        encoding = {'.gz': 'gzip', '.br': 'br'}.get(ext)
+        with open(os.path.join(target, name), 'rb') as f:
+            files.setdefault(base if encoding else name, {})[encoding or 'identity'] = f.read()
+    return files
+
+
+def reset():
+    global _files
+    _files = None
+
+
+def variant(name, accept_encodings):
+    """The smallest variant of an asset the client accepts, as (data, encoding), or None if there is no such asset."""
+    global _files
+    if _files is None:
+        _files = load()
+    variants = _files.get(name)
+    if not variants:
+        return None
+    accepted = [e for e in ('br', 'gzip') if e in variants and accept_encodings[e]] + ['identity']
+    encoding = min(accepted, key=lambda e: len(variants[e]))
+    return variants[encoding], encoding
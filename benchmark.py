@@ -0,0 +1,423 @@
+"""Benchmarks, run with e.g. `python benchmark.py spatial --mongodb-uri mongodb://localhost/teslasuc_bench`.
+
+Comparisons against MongoDB only run when a MongoDB URI is given, they use scratch collections prefixed with bench_.
+The endpoints benchmark fills a whole scratch database with synthetic data, its name has to contain "bench".
+Results are saved with --output and compared to an earlier run with --compare.
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+from datetime import timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+
+from search import SearchIndex
+from spatial import KdTree
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def summarize(name, durations):
+    total = sum(durations)
+    result = {
+        'name': name,
+        'count': len(durations),
+        'throughput': len(durations) / total if total > 0 else None,
+        'p50': percentile(durations, 50) * 1000,
+        'p95': percentile(durations, 95) * 1000,
+        'p99': percentile(durations, 99) * 1000,
+    }
+    print('%-40s n=%-6d %10.1f/s  p50=%8.3fms  p95=%8.3fms  p99=%8.3fms'
+          % (name, result['count'], result['throughput'] or 0, result['p50'], result['p95'], result['p99']))
+    return result
+
+
+def measure(name, queries, run):
+    durations = []
+    for q in queries:
+        start = perf_counter()
+        run(q)
+        durations.append(perf_counter() - start)
+    return summarize(name, durations)
+
+
+def synthetic_locations(n, seed=1):
+    r = random.Random(seed)
+    return [(r.uniform(36, 70), r.uniform(-10, 30), 'suc%d' % i) for i in range(n)]
+
+
+countries = ['CH', 'DE', 'AT', 'FR', 'IT', 'NL', 'BE', 'NO', 'SE', 'DK', 'ES', 'PL']
+problems = ['none', 'none', 'none', 'limitedPower', 'partialFailure']
+
+
+def synthetic_raw_locations(n, seed=1):
+    """n superchargers spread over the countries, as listed by the all-locations endpoint of tesla.com."""
+    r = random.Random(seed)
+    words = ['Nord', 'Süd', 'Ost', 'West', 'Zentrum', 'Flughafen', 'Bahnhof', 'Autobahn', 'Raststätte', 'Hotel']
+    return [{
+        'location_id': 'suc%d' % i,
+        'title': '%s %s %d' % (r.choice(words), r.choice(words), i),
+        'common_name': 'Common %d' % i,
+        'country': countries[i % len(countries)],
+        'region': 'europe',
+        'chargers': '<p><strong>Charging</strong><br />%d Superchargers, available 24/7</p>' % r.choice([4, 6, 8, 12, 16]),
+        'latitude': str(lat),
+        'longitude': str(lng),
+    } for i, (lat, lng, value) in enumerate(synthetic_locations(n, seed))]
+
+
+def synthetic_checkins(locations, m, days=60, seed=4):
+    """m checkins at random times of the last days, for the suc documents in locations."""
+    r = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    for i in range(m):
+        suc = r.choice(locations)
+        charging = r.randint(0, suc['stalls'])
+        yield {
+            'suc': {k: suc[k] for k in ('locationId', 'title', 'country', 'stalls', 'loc')},
+            'submitter': {'userAgent': 'benchmark', 'ip': None, 'time': now, 'tffUserId': 'bench%d' % (i % 50)},
+            'checkin': {
+                'time': now - timedelta(seconds=r.uniform(0, days * 86400)),
+                'charging': charging,
+                'blocked': r.randint(0, suc['stalls'] - charging),
+                'waiting': r.randint(0, 3),
+                'problem': r.choice(problems),
+                'affectedStalls': [],
+                'notes': '',
+            },
+        }
+
+
+class LocationServer:
+    """Serves the synthetic locations like tesla.com does, for the import benchmarks."""
+    def __init__(self, locations):
+        body = json.dumps(locations).encode('utf-8')
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/all-locations' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def bench_spatial(args):
+    locations = synthetic_locations(args.locations)
+    r = random.Random(2)
+    queries = [(r.uniform(36, 70), r.uniform(-10, 30)) for i in range(args.queries)]
+
+    start = perf_counter()
+    tree = KdTree(locations)
+    print('k-d tree build, locations=%d: %.3fs' % (len(tree), perf_counter() - start))
+
+    results = [
+        measure('kdtree radius=%dm' % args.radius, queries, lambda q: tree.within(q[0], q[1], args.radius)),
+        measure('kdtree k=%d' % args.k, queries, lambda q: tree.nearest(q[0], q[1], args.k)),
+    ]
+
+    if args.mongodb_uri:
+        collection = MongoClient(args.mongodb_uri).get_database().bench_suc
+        collection.drop()
+        collection.insert_many([{'locationId': v, 'type': 'supercharger', 'loc': {'type': "Point", 'coordinates': [lng, lat]}}
+                                for lat, lng, v in locations])
+        collection.create_index([("loc", pymongo.GEOSPHERE)])
+
+        def near(q, limit=0, **near_args):
+            geometry = {'$geometry': {'type': "Point", 'coordinates': [q[1], q[0]]}}
+            geometry.update(near_args)
+            return list(collection.find({'loc': {'$near': geometry}, 'type': 'supercharger'}, {'_id': False, 'loc': False})
+                        .limit(limit))
+
+        results += [
+            measure('$near radius=%dm' % args.radius, queries, lambda q: near(q, **{'$maxDistance': args.radius})),
+            measure('$near k=%d' % args.k, queries, lambda q: near(q, limit=args.k)),
+        ]
+        collection.drop()
+    return results
+
+
+def bench_search(args):
+    r = random.Random(3)
+    words = ['Zürich', 'Bern', 'Basel', 'Neuberg', 'München', 'Berlin', 'Hamburg', 'Lyon', 'Paris', 'Milano', 'Wien',
+             'Graz', 'Oslo', 'Göteborg', 'Kraków', 'Brno', 'Gent', 'Aachen', 'Dijon', 'Bolzano']
+    titles = ['%s %s' % (r.choice(words), r.choice(words)) if i % 2 else r.choice(words) + ' ' + str(i)
+              for i in range(args.locations)]
+    queries = [r.choice(words)[:r.randint(1, 6)].lower() for i in range(args.queries)]
+
+    start = perf_counter()
+    index = SearchIndex(((t, 'suc%d' % i, None), {'locationId': 'suc%d' % i, 'title': t}) for i, t in enumerate(titles))
+    print('search index build, locations=%d: %.3fs' % (len(index), perf_counter() - start))
+
+    results = [
+        measure('index cold', queries, lambda q: index.search(q, args.limit)),
+        measure('index warm', queries, lambda q: index.search(q, args.limit)),
+    ]
+
+    if args.mongodb_uri:
+        collection = MongoClient(args.mongodb_uri).get_database().bench_suc
+        collection.drop()
+        collection.insert_many([{'locationId': 'suc%d' % i, 'title': t, 'type': 'supercharger'} for i, t in enumerate(titles)])
+        collection.create_index('title')
+        results.append(measure('$regex', queries, lambda q: list(collection.find(
+            {'title': {'$regex': re.escape(q), '$options': 'i'}, 'type': 'supercharger'}, {'_id': False}).limit(args.limit))))
+        collection.drop()
+    return results
+
+
+def bench_endpoints(args):
+    if args.stand_in:
+        import mongomock
+        mongomock.patch(servers=(('localhost', 27017),)).start()
+        args.mongodb_uri = 'mongodb://localhost/teslasuc_bench'
+    if not args.mongodb_uri or 'bench' not in args.mongodb_uri.split('/')[-1]:
+        raise SystemExit('endpoints needs --mongodb-uri of a scratch database whose name contains "bench", or --stand-in')
+
+    # api connects when it is imported
+    os.environ['MONGODB_URI'] = args.mongodb_uri
+    import api
+    import run_import
+    db = api.db
+    for name in db.list_collection_names():
+        if not name.startswith('system.'):
+            db[name].delete_many({})
+
+    raw = synthetic_raw_locations(args.sucs)
+    server = LocationServer(raw)
+    results = []
+    try:
+        start = perf_counter()
+        run_import.import_from_url(server.url, 'supercharger', db.suc, True)
+        results.append(summarize('import suc, new', [perf_counter() - start]))
+        start = perf_counter()
+        run_import.import_from_url(server.url, 'supercharger', db.suc, True)
+        results.append(summarize('import suc, unchanged', [perf_counter() - start]))
+    finally:
+        server.close()
+
+    locations = list(db.suc.find({'type': 'supercharger'}, {'_id': False, 'raw': False}))
+    checkins = list(synthetic_checkins(locations, args.checkins))
+    start = perf_counter()
+    for i in range(0, len(checkins), 1000):
+        db.checkin.insert_many(checkins[i:i + 1000])
+    print('checkins loaded, count=%d: %.3fs' % (len(checkins), perf_counter() - start))
+    # the summaries are derived from the loaded checkins like after a deploy
+    api.overview_summary.rebuild(db)
+    api.rollups.rebuild(db)
+
+    client = api.app.test_client()
+    r = random.Random(5)
+    n = args.requests
+
+    def get(url):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        return response.get_data()
+
+    def checkin(location):
+        return {'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'locationId': location['locationId'], 'stalls': location['stalls'], 'charging': 1, 'blocked': 0,
+                'waiting': 0, 'problem': 'none', 'affectedStalls': [], 'tffUserId': 'bench', 'notes': ''}
+
+    def post(url, data):
+        response = client.post(url, data=json.dumps(data), content_type='application/json')
+        assert response.status_code == 200, response.status_code
+
+    def sample(count):
+        return [r.choice(locations) for i in range(count)]
+
+    text_queries = [l['title'].split()[r.randint(0, 1)][:r.randint(2, 6)] for l in sample(n)]
+    results += [
+        measure('GET /overview', range(n), lambda q: get('/overview')),
+        measure('GET /lookup text', text_queries, lambda q: get('/lookup?query=' + q)),
+        measure('GET /lookup lat,lng', sample(n), lambda l: get('/lookup?query=%f,%f' % (
+            l['loc']['coordinates'][1], l['loc']['coordinates'][0]))),
+        measure('GET /checkin limit=100', range(n), lambda q: get('/checkin?limit=100')),
+        measure('GET /checkin csv limit=1000', range(max(1, n // 10)), lambda q: get('/checkin?format=csv&limit=1000')),
+        measure('GET /stats', range(n), lambda q: get('/stats')),
+        measure('GET /stats/country', [r.choice(countries) for i in range(n)], lambda c: get('/stats/country/' + c)),
+        measure('GET /stats/superCharger day', sample(n), lambda l: get(
+            '/stats/superCharger/%s?resolution=day' % l['locationId'])),
+        measure('POST /checkin', sample(n), lambda l: post('/checkin', checkin(l))),
+        measure('POST /checkinBatch size=50', range(max(1, n // 10)), lambda q: post(
+            '/checkinBatch', [checkin(l) for l in sample(50)])),
+    ]
+
+    rows = ['%s,%s,%s,%d,%d,0,0' % (c['checkin']['time'].strftime('%m/%d/%Y'), c['checkin']['time'].strftime('%H:%M'),
+                                    c['suc']['title'], c['suc']['stalls'], c['checkin']['charging'])
+            for c in synthetic_checkins(locations, args.import_rows, seed=6)]
+    start = perf_counter()
+    response = client.post('/checkinImport', data='\n'.join(rows))
+    assert response.status_code == 200, response.status_code
+    results.append(summarize('POST /checkinImport rows=%d' % len(rows), [perf_counter() - start]))
+    return results
+
+
+def bench_json(args):
+    import serialize
+    from lib import TimeFormat
+
+    class StrftimeEncoder(json.JSONEncoder):
+        """The encoder api.py used before serialize.py."""
+        def default(self, o):
+            if isinstance(o, ObjectId):
+                return str(o)
+            elif isinstance(o, datetime.datetime):
+                return o.strftime(TimeFormat)
+            return json.JSONEncoder.default(self, o)
+
+    def before(o):
+        return json.dumps(o, cls=StrftimeEncoder, separators=(',', ':'), sort_keys=True)
+
+    locations = [{'locationId': 'suc%d' % i, 'title': 'Zürich %d' % i, 'country': 'CH', 'stalls': 8,
+                  'loc': {'type': 'Point', 'coordinates': [lng, lat]}}
+                 for i, (lat, lng, value) in enumerate(synthetic_locations(100))]
+    checkins = [{'_id': ObjectId(), 'time': c['checkin']['time'], 'suc': c['suc'], 'charging': c['checkin']['charging'],
+                 'problem': c['checkin']['problem'], 'notes': c['checkin']['notes']}
+                for c in synthetic_checkins(locations, args.items)]
+    documents = [checkins[i:i + args.page] for i in range(0, len(checkins), args.page)]
+    for d in documents:
+        assert before(d) == serialize.dumps(d)
+
+    return [
+        measure('json.dumps, strftime, page=%d' % args.page, documents, before),
+        measure('serialize.dumps, page=%d' % args.page, documents, serialize.dumps),
+    ]
+
+
+startup_script = """
+import json, time
+start = time.perf_counter()
+from pymongo import monitoring
+
+class Commands(monitoring.CommandListener):
+    count = 0
+    def started(self, event):
+        Commands.count += 1
+    def succeeded(self, event):
+        pass
+    def failed(self, event):
+        pass
+
+monitoring.register(Commands())
+import api
+print(json.dumps({'seconds': time.perf_counter() - start, 'commands': Commands.count}))
+"""
+
+
+def measure_startup(mongodb_uri):
+    """Time to import api in a new interpreter, as a gunicorn worker does, and the MongoDB commands it sends."""
+    output = subprocess.check_output([sys.executable, '-c', startup_script], env=dict(os.environ, MONGODB_URI=mongodb_uri),
+                                     cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def bench_startup(args):
+    # nothing listens on this address, startup must neither wait for nor fail on the database
+    uri = args.mongodb_uri or 'mongodb://127.0.0.1:9/teslasuc_bench'
+    runs = [measure_startup(uri) for i in range(args.runs)]
+    print('MongoDB commands during startup: %d' % max(r['commands'] for r in runs))
+    return [summarize('import api', [r['seconds'] for r in runs])]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(path, args, results):
+    with open(path, 'w') as f:
+        json.dump({'benchmark': args.benchmark, 'commit': git_commit(),
+                   'time': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                   'args': {k: v for k, v in vars(args).items() if k not in ('run', 'mongodb_uri', 'output', 'compare')},
+                   'results': results}, f, indent=2, sort_keys=True)
+    print('saved to %s' % path)
+
+
+def compare(path, results):
+    """Print the change of the latencies against the results saved in path, positive is slower."""
+    with open(path) as f:
+        previous = json.load(f)
+    before = {r['name']: r for r in previous['results']}
+    print('compared to %s (commit %s):' % (path, previous.get('commit')))
+    for r in results:
+        if r['name'] in before:
+            b = before[r['name']]
+            print('%-40s ' % r['name'] + '  '.join('%s %+7.1f%%' % (p, (r[p] / b[p] - 1) * 100 if b[p] else 0)
+                                                    for p in ('p50', 'p95', 'p99')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mongodb-uri', default=os.getenv('TESLASUC_BENCH_MONGODB_URI', None))
+    parser.add_argument('--output', help='save the results as json to this file')
+    parser.add_argument('--compare', help='compare with results saved earlier by --output')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    spatial = subparsers.add_parser('spatial', help='k-d tree against $near for coordinate lookups')
+    spatial.add_argument('--locations', type=int, default=5000)
+    spatial.add_argument('--queries', type=int, default=1000)
+    spatial.add_argument('--radius', type=int, default=20000)
+    spatial.add_argument('--k', type=int, default=10)
+    spatial.set_defaults(run=bench_spatial)
+
+    search = subparsers.add_parser('search', help='search index against $regex for text lookups')
+    search.add_argument('--locations', type=int, default=5000)
+    search.add_argument('--queries', type=int, default=2000)
+    search.add_argument('--limit', type=int, default=20)
+    search.set_defaults(run=bench_search)
+
+    endpoints = subparsers.add_parser('endpoints', help='all endpoints and imports against a synthetic database')
+    endpoints.add_argument('--sucs', type=int, default=2000)
+    endpoints.add_argument('--checkins', type=int, default=50000)
+    endpoints.add_argument('--requests', type=int, default=200)
+    endpoints.add_argument('--import-rows', type=int, default=1000)
+    endpoints.add_argument('--stand-in', action='store_true', help='run against an in-process mongomock database')
+    endpoints.set_defaults(run=bench_endpoints)
+
+    json_parser = subparsers.add_parser('json', help='response serialization before and after serialize.py')
+    json_parser.add_argument('--items', type=int, default=100000)
+    json_parser.add_argument('--page', type=int, default=1000)
+    json_parser.set_defaults(run=bench_json)
+
+    startup = subparsers.add_parser('startup', help='worker startup time and database traffic')
+    startup.add_argument('--runs', type=int, default=10)
+    startup.set_defaults(run=bench_startup)
+
+    args = parser.parse_args()
+    results = args.run(args)
+    if args.compare:
+        compare(args.compare, results)
+    if args.output:
+        save(args.output, args, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+from pymongo import ReturnDocument
+
+
+class VersionedCache:
+    """Per-process cache of values derived from the database, kept consistent across processes by a version counter.
+
+    Whoever changes the underlying data calls invalidate(), which bumps the version stored in db.meta. Other
+    processes notice the new version within check_interval seconds and drop their entries. A value is only stored
+    if the version did not change while it was computed, otherwise it might have been computed from the data before
+    the change.
+    """
+    def __init__(self, name, check_interval=30, max_entries=None):
+        self.name = name
+        self.check_interval = check_interval
+        # all entries are dropped when there are this many, values of one version are cheap to compute again
+        self.max_entries = max_entries
+        self.entries = {}
+        self.version = None
+        self.checked = None
+        # threaded gunicorn workers share the cache, imports invalidate it from a job thread
+        self.lock = threading.Lock()
+
+    def check(self, db):
+        """The current version, reading it from db.meta if it was not looked at for check_interval seconds."""
+        now = time.monotonic()
+        seen = self.version
+        if self.checked is None or now - self.checked > self.check_interval:
+            self.checked = now
+            meta = db.meta.find_one({'_id': self.name})
+            v = meta['version'] if meta else 0
+            with self.lock:
+                # an invalidate() meanwhile knows a version at least as new
+                if self.version == seen and v != seen:
+                    self.entries.clear()
+                    self.version = v
+        return self.version
+
+    def peek(self, key):
+        """The cached value of key, None if there is none."""
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, version, key, value):
+        """Store value if version, as returned by check() before computing it, is still the current one."""
+        with self.lock:
+            if version != self.version:
+                return False
+            if self.max_entries and len(self.entries) >= self.max_entries and key not in self.entries:
+                self.entries.clear()
+            self.entries[key] = value
+            return True
+
+    def get(self, db, key, compute):
+        version = self.check(db)
+        value = self.peek(key)
+        if value is None:
+            value = compute()
+            self.put(version, key, value)
+        return value
+
+    def invalidate(self, db):
+        meta = db.meta.find_one_and_update({'_id': self.name}, {'$inc': {'version': 1}},
+                                           upsert=True, return_document=ReturnDocument.AFTER)
+        with self.lock:
+            self.entries.clear()
+            self.version = meta['version']
+            self.checked = time.monotonic()
+
+
+class LruCache:
+    """Bounded per-process cache, evicting the least recently used entry and expiring entries after ttl seconds."""
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # threaded gunicorn workers share the cache between requests
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses}
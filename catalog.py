@@ -0,0 +1,139 @@
+import pymongo
+
+from cache import LruCache, VersionedCache
+from search import SearchIndex
+from spatial import KdTree
+import metrics
+
+# workers only notice an import done by another process when they look at the catalog version again
+_cache = VersionedCache('catalog', check_interval=30)
+# locations are looked up for every checkin, the ttl bounds staleness if a version bump is ever missed
+_locations = LruCache(max_size=5000, ttl=600)
+_locations_version = None
+
+
+def version(db):
+    """Catalog version as last seen by this process, reloading the cache when another process has imported."""
+    return _cache.check(db)
+
+
+def cached(db, key, compute):
+    return _cache.get(db, key, compute)
+
+
+def invalidate(db):
+    """Called after every import, bumps the catalog version so that all processes drop their cached views."""
+    global _locations_version
+    _cache.invalidate(db)
+    _locations.clear()
+    _locations_version = _cache.version
+
+
+def location(db, location_id):
+    """The charger with the given locationId or None, the fields needed to store a checkin served from the cache."""
+    return locations(db, [location_id]).get(location_id)
+
+
+def locations(db, location_ids):
+    """Chargers by locationId for the given ids, those not in the cache are read in one query."""
+    global _locations_version
+    v = version(db)
+    if v != _locations_version:
+        _locations.clear()
+        _locations_version = v
+
+    result = {}
+    missing = []
+    for location_id in set(location_ids):
+        found = _locations.get(location_id)
+        if found is None:
+            missing.append(location_id)
+        else:
+            result[location_id] = found
+
+    if missing:
+        for found in db.suc.find({'locationId': {'$in': missing}}, {'_id': False, 'locationId': True, 'title': True,
+                                                                   'country': True, 'stalls': True, 'loc': True}):
+            # not kept if an import was done meanwhile, it might have been read before the import
+            if _cache.version == v:
+                _locations.put(found['locationId'], found)
+            result[found['locationId']] = found
+
+    metrics.location_cache_lookups.labels('hit').inc(len(set(location_ids)) - len(missing))
+    metrics.location_cache_lookups.labels('miss').inc(len(missing))
+    metrics.location_cache_size.set(len(_locations))
+    return result
+
+
+def location_stats():
+    return _locations.stats()
+
+
+def type_counts(db):
+    """Number of locations per type, e.g. supercharger."""
+    return cached(db, 'typeCounts', lambda: {s['_id']: s['count'] for s in db.suc.aggregate([
+        {'$group': {'_id': '$type', 'count': {'$sum': 1}}}
+    ])})
+
+
+def countries(db):
+    return cached(db, 'countries', lambda: [s['_id'] for s in db.suc.aggregate([
+        {'$match': {'type': 'supercharger'}},
+        {'$group': {'_id': '$country', 'count': {'$sum': 1}}},
+        {'$match': {'count': {'$gte': 4}}},
+        {'$sort': {'_id': 1}}
+    ])])
+
+
+def super_chargers(db, country):
+    def compute():
+        query = {'type': 'supercharger'}
+        if country:
+            if country == 'others':
+                query['country'] = {'$nin': countries(db)}
+            else:
+                query['country'] = country
+
+        return [s for s in db.suc
+                .find(query, {'_id': False, 'locationId': True, 'title': True, 'country': True, 'stalls': True})
+                .sort([('country', pymongo.ASCENDING), ('title', pymongo.ASCENDING)])]
+
+    # unknown countries yield no super chargers and are not cached, so the cache stays bounded by the catalog
+    key = ('superChargers', country)
+    v = version(db)
+    result = _cache.peek(key)
+    if result is None:
+        result = compute()
+        if result:
+            _cache.put(v, key, result)
+    return result
+
+
+def spatial_index(db):
+    """k-d tree of the superchargers, the values are the documents as returned by /lookup."""
+    def compute():
+        sucs = db.suc.find({'type': 'supercharger', 'loc': {'$exists': True}},
+                           {'raw': False, '_id': False, 'type': False, 'hash': False})
+        return KdTree((s['loc']['coordinates'][1], s['loc']['coordinates'][0], {k: v for k, v in s.items() if k != 'loc'})
+                      for s in sucs)
+
+    return cached(db, 'spatialIndex', compute)
+
+
+def search_index(db):
+    """Text search over title, locationId and common name of the superchargers, values as returned by /lookup."""
+    def compute():
+        sucs = db.suc.find({'type': 'supercharger'}, {'raw.common_name': True, '_id': False, 'locationId': True,
+                                                      'title': True, 'country': True, 'stalls': True})
+        return SearchIndex(((s.get('title'), s.get('locationId'), s.pop('raw', {}).get('common_name')), s) for s in sucs)
+
+    return cached(db, 'searchIndex', compute)
+
+
+def title_index(db):
+    """Text search over the titles of all locations, the values are their locationIds."""
+    def compute():
+        return SearchIndex(((s.get('title'),), s['locationId'])
+                           for s in db.suc.find({}, {'_id': False, 'locationId': True, 'title': True}))
+
+    return cached(db, 'titleIndex', compute)
@@ -1,18 +1,26 @@
 import logging.config
 import json
 import os
-import pymongo
 from pymongo import MongoClient
 
+import metrics
+
+_logger = None
+_client = None
+_client_pid = None
+
 
 def setup_logging():
-    logging.config.fileConfig('logging.conf', defaults={})
-    logger = logging.getLogger('suc')
-    logger.setLevel(logging.DEBUG)
-    return logger
+    # every module calls this when it is imported, the configuration is only read once
+    global _logger
+    if _logger is None:
+        logging.config.fileConfig('logging.conf', defaults={})
+        _logger = logging.getLogger('suc')
+        _logger.setLevel(logging.DEBUG)
+    return _logger
 
 
-def setup_db():
+def mongodb_uri():
     mongo_url = os.getenv('MONGODB_URI', None)
     if mongo_url:
         db_name = mongo_url.split('/')[-1]
@@ -20,21 +28,22 @@ def setup_db():
         vcap_services = json.loads(os.getenv("VCAP_SERVICES"))
         mongo_url = vcap_services["mongodb"][0]["credentials"]["uri"]
         db_name = vcap_services["mongodb"][0]["credentials"]["database"]
+    return mongo_url, db_name
+
 
-    db = MongoClient(mongo_url)[db_name]
-
-    suc_collection = db.suc
-    #suc_collection.ensure_index([('type', pymongo.ASCENDING)])
-    suc_collection.create_index("type")
-    suc_collection.create_index("title")
-    suc_collection.create_index("locationId")
-    suc_collection.create_index("country")
-    suc_collection.create_index([("loc", pymongo.GEOSPHERE)])
-    suc_collection.create_index([("type", pymongo.ASCENDING), ("locationId", pymongo.ASCENDING)], unique=True)
-
-    checkin_colleciton = db.checkin
-    checkin_colleciton.create_index("suc.country")
-    checkin_colleciton.create_index("checkin.time")
-    checkin_colleciton.create_index("submitter.time")
-    checkin_colleciton.create_index("suc.locationId")
-    return db
+def client():
+    """The MongoClient of this process, it connects on first use and is created again after a fork."""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        mongo_url, db_name = mongodb_uri()
+        _client = MongoClient(mongo_url, connect=False,
+                              maxPoolSize=int(os.getenv('TESLASUC_MONGODB_MAX_POOL_SIZE', 100)),
+                              minPoolSize=int(os.getenv('TESLASUC_MONGODB_MIN_POOL_SIZE', 0)),
+                              event_listeners=[metrics.CommandMetrics()])
+        _client_pid = os.getpid()
+    return _client
+
+
+def setup_db():
+    """The database, without talking to it, indexes are created by `python manage.py migrate`."""
+    return client()[mongodb_uri()[1]]
@@ -0,0 +1,62 @@
+import os
+import threading
+import time
+
+from cache import VersionedCache
+
+# responses served by another worker may lag a change by up to check_interval seconds, which is also their max-age
+_version = VersionedCache('data', check_interval=5)
+max_age = _version.check_interval
+# stored checkins bump the version at most this often per process, responses lag them by max_age anyway
+bump_interval = max_age
+
+_lock = threading.Lock()
+_last_bump = None
+_timer = None
+_timer_pid = None
+
+
+def bump(db):
+    """Called whenever the catalog changed or checkins were imported, stored checkins go through changed()."""
+    _version.invalidate(db)
+
+
+def changed(db):
+    """Called whenever checkins were stored, a burst of them bumps the version twice instead of once per checkin.
+
+    The first change after a quiet bump_interval bumps right away, those within the interval are folded into one
+    bump at its end.
+    """
+    global _last_bump, _timer, _timer_pid
+    with _lock:
+        now = time.monotonic()
+        if _timer is not None and _timer_pid == os.getpid():
+            return
+        if _last_bump is not None and now - _last_bump < bump_interval:
+            # a timer of the parent process does not survive the fork of a gunicorn worker
+            _timer = threading.Timer(_last_bump + bump_interval - now, _deferred_bump, [db])
+            _timer.daemon = True
+            _timer_pid = os.getpid()
+            _timer.start()
+            return
+        _last_bump = now
+    bump(db)
+
+
+def _deferred_bump(db):
+    global _last_bump, _timer
+    with _lock:
+        _timer = None
+        _last_bump = time.monotonic()
+    bump(db)
+
+
+def etag(db, slot=None):
+    """ETag of everything derived from checkins and the catalog, read from MongoDB at most every check_interval.
+
+    Views which also change with time, like the overview aging out old checkins, pass the length of a time slot.
+    """
+    tag = 'v%d' % _version.check(db)
+    if slot:
+        tag += '-%d' % (time.time() // slot.total_seconds())
+    return tag
@@ -0,0 +1,228 @@
+import os
+import queue
+import threading
+from collections import deque
+from time import monotonic, sleep
+
+from bson.objectid import ObjectId
+from pymongo import CursorType, DESCENDING
+from pymongo.errors import BulkWriteError
+
+from config import setup_logging
+
+logger = setup_logging()
+
+# events are written to a capped collection, every process tails it once and fans the events out to its streams
+capped_size = 16 * 1024 * 1024
+max_events = 100000
+# recent events kept per process, a stream resuming after one of them does not need to query the database
+buffer_size = 1000
+max_pending = 1000
+keepalive = 15
+# publishers racing for the same sequence numbers retry this often
+max_publish_attempts = 10
+# every open stream holds one of the connections of its gevent worker, see gunicorn.conf.py, beyond this many
+# streams a client is asked to come back later so there are connections left for the other requests
+max_streams = int(os.getenv('TESLASUC_MAX_STREAMS', 500))
+retry_after = 30
+
+_hub = None
+_hub_pid = None
+
+
+def point(loc):
+    return {'lat': loc['coordinates'][1], 'lng': loc['coordinates'][0]} if loc else None
+
+
+def checkin_events(submissions):
+    return [{'type': 'checkin',
+             'locationId': s['suc']['locationId'],
+             'country': s['suc']['country'],
+             'title': s['suc']['title'],
+             'loc': point(s['suc'].get('loc')),
+             'stalls': s['suc']['stalls'],
+             'time': s['checkin']['time'],
+             'charging': s['checkin']['charging'],
+             'blocked': s['checkin']['blocked'],
+             'waiting': s['checkin']['waiting'],
+             'problem': s['checkin'].get('problem'),
+             'affectedStalls': s['checkin'].get('affectedStalls'),
+             'notes': s['checkin'].get('notes'),
+             'tffUserId': s['submitter'].get('tffUserId'),
+             } for s in submissions]
+
+
+def location_event(change, d):
+    return {'type': 'location',
+            'change': change,
+            'locationId': d['locationId'],
+            'locationType': d.get('type'),
+            'country': d.get('country'),
+            'title': d.get('title'),
+            'loc': point(d.get('loc')),
+            'stalls': d.get('stalls'),
+            }
+
+
+def last_seq(db):
+    last = db.event.find_one({'seq': {'$exists': True}}, {'seq': True}, sort=[('seq', DESCENDING)])
+    return last['seq'] if last else 0
+
+
+def publish(db, events):
+    """Write events with the next sequence numbers, streams resume after the number of an event.
+
+    ObjectIds are not ordered across processes, so an event written by another worker could sort before the last
+    one a client has seen. The unique index on seq makes the insert itself claim a number, an event can only get
+    the next number once the one before is stored, so the events are stored in the order of their numbers.
+    """
+    pending = list(events)
+    try:
+        for attempt in range(max_publish_attempts):
+            if not pending:
+                return
+            first = last_seq(db) + 1
+            for i, event in enumerate(pending):
+                event['seq'] = first + i
+            try:
+                db.event.insert_many(pending)
+                return
+            except BulkWriteError as e:
+                if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                    raise
+                # another process took the number of the first event which is not stored yet
+                pending = pending[e.details['nInserted']:]
+        logger.warn("Failed to publish events, contended, count=%d" % len(pending))
+    except Exception:
+        # the data itself is stored, streams just miss these events
+        logger.exception("Failed to publish events, count=%d" % len(pending))
+
+
+def matches(event, country=None, location_ids=None):
+    return (not country or event.get('country') == country) and (not location_ids or event['locationId'] in location_ids)
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+class Hub:
+    """Fans the events of one source out to any number of subscribers, each with a bounded queue."""
+    def __init__(self, max_subscribers=None):
+        self.max_subscribers = max_streams if max_subscribers is None else max_subscribers
+        self.subscribers = set()
+        self.recent = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+
+    def dispatch(self, event):
+        with self.lock:
+            self.recent.append(event)
+            for q in list(self.subscribers):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    # a stream which does not keep up is closed, the client resumes from its last event
+                    self.subscribers.discard(q)
+                    q.overflowed = True
+
+    def subscribe(self, after=None):
+        """A queue of the events from now on, and those after the given sequence number if it is still buffered.
+
+        The backlog is None if events after the number might be missing from the buffer. Raises TooManyStreams if
+        there are max_subscribers already.
+        """
+        q = queue.Queue(max_pending)
+        q.overflowed = False
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                raise TooManyStreams()
+            self.subscribers.add(q)
+            backlog = []
+            if after is not None:
+                ids = [e['seq'] for e in self.recent]
+                backlog = list(self.recent)[ids.index(after) + 1:] if after in ids else None
+        return q, backlog
+
+    def unsubscribe(self, q):
+        with self.lock:
+            self.subscribers.discard(q)
+
+
+def tail(db, hub, stop=None):
+    """Feed hub from the capped collection, starting with the events written from now on."""
+    after = last_seq(db)
+    while not (stop and stop.is_set()):
+        try:
+            cursor = db.event.find({'seq': {'$gt': after}}, cursor_type=CursorType.TAILABLE_AWAIT)
+            while cursor.alive and not (stop and stop.is_set()):
+                for event in cursor:
+                    hub.dispatch(event)
+                    after = event['seq']
+        except Exception:
+            logger.exception("Failed to tail events")
+        # a tailable cursor on an empty collection dies at once
+        sleep(1)
+
+
+def hub(db):
+    # one tailing thread per gunicorn worker, threads do not survive a fork
+    global _hub, _hub_pid
+    if _hub is None or _hub_pid != os.getpid():
+        _hub = Hub()
+        _hub_pid = os.getpid()
+        threading.Thread(target=tail, args=(db, _hub), name='events', daemon=True).start()
+    return _hub
+
+
+def stream(db, encode, country=None, location_ids=None, after=None):
+    """Server-sent events of the matching events, after the given sequence number or from now on.
+
+    Subscribes right away, so no event is missed between the request and the first read of the stream. Raises
+    TooManyStreams if this process serves max_streams already.
+    """
+    h = hub(db)
+    q, backlog = h.subscribe(after)
+    if backlog is None:
+        backlog = list(db.event.find({'seq': {'$gt': after}}).sort('seq', 1))
+
+    def generate():
+        try:
+            sent = set()
+            for event in backlog:
+                sent.add(event['seq'])
+                if matches(event, country, location_ids):
+                    yield format_event(event, encode)
+
+            last_sent = monotonic()
+            while not q.overflowed:
+                try:
+                    event = q.get(timeout=keepalive)
+                except queue.Empty:
+                    event = None
+                if event is not None and event['seq'] not in sent and matches(event, country, location_ids):
+                    yield format_event(event, encode)
+                    last_sent = monotonic()
+                elif monotonic() - last_sent >= keepalive:
+                    # keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    last_sent = monotonic()
+        finally:
+            h.unsubscribe(q)
+
+    return generate()
+
+
+def format_event(event, encode):
+    return 'id: %d\ndata: %s\n\n' % (event['seq'], encode({k: v for k, v in event.items() if k not in ('_id', 'seq')}))
+
+
+def parse_id(s):
+    """Sequence number of a Last-Event-ID, raises ValueError if it is not one of ours.
+
+    None for the ObjectIds handed out before sequence numbers, those streams continue from now on.
+    """
+    if ObjectId.is_valid(s):
+        return None
+    if not s.isdigit():
+        raise ValueError("Invalid event id")
+    return int(s)
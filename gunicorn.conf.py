@@ -0,0 +1,29 @@
+import os
+import shutil
+
+# /events keeps a request open for as long as a client listens, with gevent an open stream costs a greenlet and
+# not one of the few threads which serve all other requests, see TESLASUC_MAX_STREAMS in events.py
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+# only used with GUNICORN_WORKER_CLASS=gthread, then TESLASUC_MAX_STREAMS has to stay well below it
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+
+# metrics of all workers are merged through files in this directory, see metrics.py
+os.environ.setdefault('prometheus_multiproc_dir', '/tmp/teslasuc-metrics')
+
+
+def on_starting(server):
+    path = os.environ['prometheus_multiproc_dir']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # checkins queued by the write-behind ingestion are stored before the worker goes away
+    import ingest
+    ingest.shutdown()
@@ -0,0 +1,98 @@
+import datetime
+from datetime import timedelta
+
+from cache import VersionedCache
+
+resolutions = {
+    'hour': timedelta(hours=1),
+    'day': timedelta(days=1),
+    'week': timedelta(weeks=1),
+}
+
+unix_epoch = datetime.datetime(1970, 1, 1)
+# buckets are aligned to this monday, so weeks start on mondays
+epoch = datetime.datetime(1970, 1, 5)
+# checkins can be back dated by up to a month, buckets older than that never change again
+late_checkins = timedelta(days=31)
+
+max_cached = 1000
+
+_cache = VersionedCache('history', check_interval=30, max_entries=max_cached)
+
+
+def floor(t, size):
+    return epoch + ((t - epoch) // size) * size
+
+
+def aggregate(db, location_id, size, start=None, end=None):
+    """Buckets of the checkins of a location in [start, end), computed by the database in a single pass."""
+    query = {'suc.locationId': location_id}
+    if start or end:
+        query['checkin.time'] = {}
+        if start:
+            query['checkin.time']['$gte'] = start
+        if end:
+            query['checkin.time']['$lt'] = end
+
+    size_ms = int(size.total_seconds() * 1000)
+    offset_ms = int((epoch - unix_epoch).total_seconds() * 1000)
+    bucket = {'$subtract': ['$checkin.time', {'$mod': [
+        {'$subtract': [{'$subtract': ['$checkin.time', unix_epoch]}, offset_ms]}, size_ms]}]}
+    with_problem = {'$and': [{'$gt': ['$checkin.problem', None]}, {'$ne': ['$checkin.problem', 'none']}]}
+
+    return [{'time': b['_id'],
+             'count': b['count'],
+             'stalls': b['stalls'],
+             'charging': b['charging'],
+             'chargingMax': b['chargingMax'],
+             'waiting': b['waiting'],
+             'waitingMax': b['waitingMax'],
+             'blocked': b['blocked'],
+             'blockedMax': b['blockedMax'],
+             'problemShare': b['problemShare'],
+             }
+            for b in db.checkin.aggregate([
+                {'$match': query},
+                {'$group': {'_id': bucket,
+                            'count': {'$sum': 1},
+                            'stalls': {'$max': '$suc.stalls'},
+                            'charging': {'$avg': '$checkin.charging'},
+                            'chargingMax': {'$max': '$checkin.charging'},
+                            'waiting': {'$avg': '$checkin.waiting'},
+                            'waitingMax': {'$max': '$checkin.waiting'},
+                            'blocked': {'$avg': '$checkin.blocked'},
+                            'blockedMax': {'$max': '$checkin.blocked'},
+                            'problemShare': {'$avg': {'$cond': [with_problem, 1, 0]}},
+                            }},
+                {'$sort': {'_id': 1}},
+            ])]
+
+
+def invalidate(db):
+    """Called after checkins were imported, they might belong to buckets which are cached as final."""
+    _cache.invalidate(db)
+
+
+def buckets(db, location_id, resolution, start=None, end=None):
+    """Buckets of the checkins of a location in [start, end), start and end are naive UTC datetimes.
+
+    Buckets older than late_checkins are final and kept per process, only the recent ones are aggregated per call.
+    """
+    size = resolutions[resolution]
+    horizon = floor(datetime.datetime.utcnow() - late_checkins, size)
+    if start:
+        start = floor(start, size)
+
+    version = _cache.check(db)
+    key = (location_id, resolution)
+    entry = _cache.peek(key)
+    if entry is None or entry['until'] < horizon:
+        # entries are never changed but replaced, threads extending the same one concurrently store equal copies
+        until = entry['until'] if entry else None
+        entry = {'until': horizon, 'buckets': (entry['buckets'] if entry else []) + aggregate(db, location_id, size, until, horizon)}
+        _cache.put(version, key, entry)
+
+    results = [b for b in entry['buckets'] if (not start or b['time'] >= start) and (not end or b['time'] < end)]
+    if not end or end > horizon:
+        results += aggregate(db, location_id, size, max(start, horizon) if start else horizon, end)
+    return results
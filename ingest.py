@@ -0,0 +1,129 @@
+import atexit
+import os
+import queue
+import threading
+from time import monotonic
+
+from config import setup_logging
+
+logger = setup_logging()
+
+# direct: store within the request, flush: queue and answer once the batch is stored, enqueue: answer once queued
+mode = os.getenv('TESLASUC_INGEST', 'direct')
+batch_size = int(os.getenv('TESLASUC_INGEST_BATCH_SIZE', 100))
+interval = float(os.getenv('TESLASUC_INGEST_INTERVAL', 0.2))
+# bounded in requests, a request waits at most enqueue_timeout seconds for room in the queue
+max_queued = int(os.getenv('TESLASUC_INGEST_QUEUE_SIZE', 1000))
+enqueue_timeout = 1.0
+# with mode flush a request waits at most this long for its batch, well below the gunicorn timeout
+flush_timeout = float(os.getenv('TESLASUC_INGEST_FLUSH_TIMEOUT', 5))
+
+_writer = None
+_writer_pid = None
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FlushTimeout(Exception):
+    """The submissions are queued but were not stored within flush_timeout, they may still be stored later."""
+    pass
+
+
+class WriteBehind:
+    """Stores queued checkins from a background thread, a batch is written when it is big or old enough.
+
+    store(submissions) writes a list of checkins and returns the indices of those which could not be stored.
+    """
+    def __init__(self, store, batch_size=100, interval=0.2, max_queued=1000):
+        self.store = store
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue(max_queued)
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+
+    def put(self, submissions, wait=False, timeout=None):
+        """Queue submissions, with wait the indices which failed are returned once they were written."""
+        pending = {'submissions': submissions, 'done': threading.Event(), 'failed': set()}
+        try:
+            self.queue.put(pending, timeout=enqueue_timeout)
+        except queue.Full:
+            raise QueueFull()
+        if wait and not pending['done'].wait(flush_timeout if timeout is None else timeout):
+            raise FlushTimeout()
+        return pending['failed']
+
+    def run(self):
+        stopped = False
+        while not stopped:
+            first = self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            count = len(first['submissions'])
+            deadline = monotonic() + self.interval
+            while count < self.batch_size:
+                try:
+                    pending = self.queue.get(timeout=max(0, deadline - monotonic()))
+                except queue.Empty:
+                    break
+                if pending is None:
+                    stopped = True
+                    break
+                batch.append(pending)
+                count += len(pending['submissions'])
+            self.flush(batch)
+
+    def flush(self, batch):
+        submissions = [s for pending in batch for s in pending['submissions']]
+        try:
+            failed = self.store(submissions)
+        except Exception:
+            logger.exception("Failed to store checkins, count=%d" % len(submissions))
+            failed = set(range(len(submissions)))
+
+        offset = 0
+        for pending in batch:
+            n = len(pending['submissions'])
+            pending['failed'] = {i - offset for i in failed if offset <= i < offset + n}
+            pending['done'].set()
+            offset += n
+
+    def stop(self, timeout=10):
+        """Write everything queued so far and end the thread, gives up after timeout seconds."""
+        deadline = monotonic() + timeout
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.warn("Dropping queued checkins on shutdown, requests=%d" % self.queue.qsize())
+            return
+        self.thread.join(max(0, deadline - monotonic()))
+        if self.thread.is_alive():
+            logger.warn("Dropping queued checkins on shutdown, requests=%d" % self.queue.qsize())
+
+
+def writer(store):
+    # created lazily in each gunicorn worker, threads do not survive a fork
+    global _writer, _writer_pid
+    if _writer is None or _writer_pid != os.getpid():
+        _writer = WriteBehind(store, batch_size, interval, max_queued)
+        _writer_pid = os.getpid()
+    return _writer
+
+
+def submit(store, submissions):
+    """Store submissions according to mode, returns the indices which are known to have failed."""
+    if mode == 'direct':
+        return store(submissions)
+    return writer(store).put(submissions, wait=(mode == 'flush'))
+
+
+@atexit.register
+def shutdown():
+    """Flush the queue of this process, called when a worker exits, see gunicorn.conf.py."""
+    global _writer
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.stop()
+        _writer = None
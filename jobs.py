@@ -0,0 +1,91 @@
+import datetime
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from pytz import timezone
+
+from config import setup_logging
+
+logger = setup_logging()
+
+tz_utc = timezone('UTC')
+
+max_workers = 2
+# a lock left behind by a crashed worker does not block imports forever
+lock_timeout = timedelta(minutes=30)
+
+_executor = None
+_executor_pid = None
+
+
+def executor():
+    # created lazily in each gunicorn worker, threads do not survive a fork
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=max_workers)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def acquire(db, name, job_id):
+    now_utc = tz_utc.localize(datetime.datetime.utcnow())
+    try:
+        db.lock.insert_one({'_id': name, 'jobId': job_id, 'expires': now_utc + lock_timeout})
+        return True
+    except DuplicateKeyError:
+        return db.lock.find_one_and_update({'_id': name, 'expires': {'$lt': now_utc}},
+                                           {'$set': {'jobId': job_id, 'expires': now_utc + lock_timeout}}) is not None
+
+
+def release(db, name, job_id):
+    db.lock.delete_one({'_id': name, 'jobId': job_id})
+
+
+def submit(db, name, target):
+    """Run target(progress) in the background, unless a job with the same name is still running.
+
+    Returns the id of the new job or None if another one holds the lock.
+    """
+    job_id = ObjectId()
+    if not acquire(db, name, job_id):
+        return None
+
+    db.job.insert_one({
+        '_id': job_id,
+        'name': name,
+        'status': 'queued',
+        'created': tz_utc.localize(datetime.datetime.utcnow()),
+        'progress': {},
+    })
+
+    def progress(stage, **counts):
+        db.job.update_one({'_id': job_id}, {'$set': {'progress': dict(counts, stage=stage)}})
+
+    def run():
+        db.job.update_one({'_id': job_id}, {'$set': {'status': 'running', 'started': tz_utc.localize(datetime.datetime.utcnow())}})
+        try:
+            result = target(progress)
+            db.job.update_one({'_id': job_id}, {'$set': {'status': 'done', 'result': result,
+                                                         'finished': tz_utc.localize(datetime.datetime.utcnow())}})
+        except Exception as e:
+            logger.error("Job failed, name=%s, id=%s %s" % (name, job_id, traceback.format_exc()))
+            db.job.update_one({'_id': job_id}, {'$set': {'status': 'failed', 'error': str(e),
+                                                         'finished': tz_utc.localize(datetime.datetime.utcnow())}})
+        finally:
+            release(db, name, job_id)
+
+    executor().submit(run)
+    logger.info("Submitted job, name=%s, id=%s" % (name, job_id))
+    return job_id
+
+
+def status(db, job_id):
+    try:
+        return db.job.find_one({'_id': ObjectId(job_id)})
+    except InvalidId:
+        return None
@@ -1,13 +1,20 @@
 import re
+import json
 import datetime
 from collections import OrderedDict
 
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
 TimePattern = re.compile("^[0-9]{4}\-[0-9]{2}\-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}\.[0-9]{3}Z$")
 TimeFormat = "%Y-%m-%dT%H:%M:%S.%fZ"
 
 TimePatternSimple = re.compile("^[0-9]{4}\-[0-9]{2}\-[0-9]{2} [0-9]{2}:[0-9]{2}$")
 TimeFormatSimple = "%Y-%m-%d %H:%M"
 
+DatePattern = re.compile("^[0-9]{4}\-[0-9]{2}\-[0-9]{2}$")
+DateFormat = "%Y-%m-%d"
+
 
 def convert_time_fields(item):
     if not item:
@@ -22,7 +29,7 @@ def convert_time_fields(item):
             item[k] = datetime.datetime.strptime(v, TimeFormat)
 
 
-def convert_to_csv(items):
+def iter_csv(items):
     def escape(s):
         if type(s) is str and ',' in s:
             return '"' + s + '"'
@@ -31,9 +38,62 @@ def convert_to_csv(items):
     def join(items):
         return ','.join(map(lambda i: escape(i), items))
 
-    header = join(items[0].keys())
-    lines = [join(item.values()) for item in items]
-    return header + "\n" + "\n".join(lines)
+    first = True
+    for item in items:
+        if first:
+            yield join(item.keys())
+            first = False
+        yield "\n" + join(item.values())
+
+
+def convert_to_csv(items):
+    return ''.join(iter_csv(items))
+
+
+def format_cursor(time, object_id):
+    return time.strftime(TimeFormat) + '_' + str(object_id)
+
+
+def parse_cursor(s):
+    """Inverse of format_cursor, raises ValueError for malformed cursors."""
+    time, _, object_id = s.partition('_')
+    try:
+        return datetime.datetime.strptime(time, TimeFormat), ObjectId(object_id)
+    except InvalidId as e:
+        raise ValueError(str(e))
+
+
+def parse_json_array(chunks):
+    """Incrementally parse a JSON array from an iterable of text chunks, yielding one element at a time."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                break  # element continues in the next chunk
+            if end == len(buffer) and not isinstance(item, (dict, list)):
+                break  # a number or literal might continue in the next chunk
+            yield item
+            pos = end
+        buffer = buffer[pos:]
+    raise ValueError("Unexpected end of JSON array")
 
 
 def parse_user_accept_languages(header):
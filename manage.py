@@ -0,0 +1,41 @@
+"""Maintenance commands, run with e.g. `python manage.py rebuild-stats`."""
+import argparse
+
+from config import setup_logging, setup_db
+import assets
+import migrations
+import overview
+import rollups
+import snapshot
+
+logger = setup_logging()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    subparsers.add_parser('build-assets', help='write fingerprinted, compressed copies of static/ to %s' % assets.build_dir)
+    subparsers.add_parser('migrate', help='create indexes and apply other schema changes not applied yet')
+    subparsers.add_parser('rebuild-overview', help='recompute the /overview summary from the checkins')
+    subparsers.add_parser('rebuild-stats', help='recompute the /stats rollups from the checkins and the catalog')
+    subparsers.add_parser('snapshot', help='store a /snapshot of the catalog if it changed since the latest one')
+    args = parser.parse_args()
+
+    if args.command == 'build-assets':
+        assets.build()
+        return
+
+    db = setup_db()
+    if args.command == 'migrate':
+        logger.info("Schema version %d" % migrations.migrate(db))
+    elif args.command == 'rebuild-overview':
+        overview.rebuild(db)
+    elif args.command == 'rebuild-stats':
+        rollups.rebuild(db)
+    elif args.command == 'snapshot':
+        logger.info("Snapshot version %d" % snapshot.generate(db))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import os
+import threading
+from time import monotonic
+
+from flask import g, request
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from pymongo import monitoring
+
+# under gunicorn every worker writes its samples to files in this directory and a scrape merges them,
+# it has to be set and emptied before the workers start, see gunicorn.conf.py
+multiprocess_dir = os.getenv('prometheus_multiproc_dir', None)
+
+http_request_duration = Histogram('teslasuc_http_request_duration_seconds', 'Duration of HTTP requests',
+                                  ['method', 'route'])
+http_requests_in_flight = Gauge('teslasuc_http_requests_in_flight', 'HTTP requests currently handled',
+                                ['route'], multiprocess_mode='livesum')
+http_responses = Counter('teslasuc_http_responses_total', 'HTTP responses by status code',
+                         ['method', 'route', 'status'])
+
+mongodb_command_duration = Histogram('teslasuc_mongodb_command_duration_seconds', 'Duration of MongoDB commands',
+                                     ['collection', 'command'],
+                                     buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+mongodb_command_failures = Counter('teslasuc_mongodb_command_failures_total', 'Failed MongoDB commands',
+                                   ['collection', 'command'])
+
+location_cache_lookups = Counter('teslasuc_location_cache_lookups_total', 'Checkin location lookups by cache result',
+                                 ['result'])
+location_cache_size = Gauge('teslasuc_location_cache_size', 'Locations in the cache of checkin locations',
+                            multiprocess_mode='livesum')
+
+import_duration = Histogram('teslasuc_import_duration_seconds', 'Duration of catalog imports', ['type'],
+                            buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+import_documents = Counter('teslasuc_import_documents_total', 'Locations seen by catalog imports, by outcome',
+                           ['type', 'outcome'])
+import_outcomes = ['inserted', 'updated', 'unchanged', 'removed', 'failed', 'skipped']
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Latency and failures of MongoDB commands per collection, passed to the MongoClient in setup_db()."""
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.Lock()
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == 'getMore':
+            collection = event.command.get('collection')
+        with self.lock:
+            self.collections[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ''
+
+    def _finished(self, event):
+        with self.lock:
+            collection = self.collections.pop((event.connection_id, event.request_id), '')
+        mongodb_command_duration.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        return collection
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        mongodb_command_failures.labels(self._finished(event), event.command_name).inc()
+
+
+class DocumentCounts:
+    """Collection sizes, computed by the scraping process from collection metadata and the cached catalog."""
+    def __init__(self, db, type_counts):
+        self.db = db
+        self.type_counts = type_counts
+
+    def collect(self):
+        yield GaugeMetricFamily('teslasuc_checkin_count', 'Estimated number of checkins',
+                                value=self.db.checkin.estimated_document_count())
+        counts = self.type_counts(self.db)
+        yield GaugeMetricFamily('teslasuc_super_chargers_count', 'Number of super chargers',
+                                value=counts.get('supercharger', 0))
+        yield GaugeMetricFamily('teslasuc_destination_chargers_count', 'Number of destination chargers',
+                                value=counts.get('destination_charger', 0))
+
+
+def observe_import(type, result, duration):
+    import_duration.labels(type).observe(duration)
+    for outcome in import_outcomes:
+        if result.get(outcome):
+            import_documents.labels(type, outcome).inc(result[outcome])
+
+
+def instrument(app):
+    """Record duration, status and concurrency of every request handled by app, labelled by its url rule."""
+    def route():
+        return request.url_rule.rule if request.url_rule else 'unmatched'
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = monotonic()
+        g.metrics_route = route()
+        http_requests_in_flight.labels(g.metrics_route).inc()
+
+    @app.after_request
+    def observe(response):
+        if 'metrics_start' in g:
+            http_request_duration.labels(request.method, g.metrics_route).observe(monotonic() - g.metrics_start)
+            http_responses.labels(request.method, g.metrics_route, str(response.status_code)).inc()
+        return response
+
+    @app.teardown_request
+    def stop(exception=None):
+        if 'metrics_route' in g:
+            http_requests_in_flight.labels(g.metrics_route).dec()
+
+
+def render(db, type_counts):
+    """The metrics of all workers in the text exposition format, as (body, content type)."""
+    if multiprocess_dir:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    counts = CollectorRegistry()
+    counts.register(DocumentCounts(db, type_counts))
+    return generate_latest(registry) + generate_latest(counts), CONTENT_TYPE_LATEST
+
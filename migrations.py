@@ -0,0 +1,100 @@
+"""Schema changes of the database, applied in order by `python manage.py migrate`."""
+import pymongo
+
+from config import setup_logging
+import events
+import overview
+import rollups
+
+logger = setup_logging()
+
+
+def create_indexes(db):
+    suc_collection = db.suc
+    suc_collection.create_index("type")
+    suc_collection.create_index("title")
+    suc_collection.create_index("locationId")
+    suc_collection.create_index("country")
+    suc_collection.create_index([("loc", pymongo.GEOSPHERE)])
+    suc_collection.create_index([("type", pymongo.ASCENDING), ("locationId", pymongo.ASCENDING)], unique=True)
+
+    checkin_collection = db.checkin
+    checkin_collection.create_index("suc.country")
+    checkin_collection.create_index("checkin.time")
+    checkin_collection.create_index([("checkin.time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)])
+    checkin_collection.create_index("submitter.time")
+    checkin_collection.create_index("suc.locationId")
+    checkin_collection.create_index([("suc.locationId", pymongo.ASCENDING), ("checkin.time", pymongo.DESCENDING)])
+
+    db.overview.create_index("lastCheckin")
+    db.rollup.create_index([("kind", pymongo.ASCENDING), ("country", pymongo.ASCENDING)])
+
+
+def create_event_collection(db):
+    if 'event' not in db.list_collection_names():
+        db.create_collection('event', capped=True, size=events.capped_size, max=events.max_events)
+
+
+def create_overview_updated_index(db):
+    db.overview.create_index("updated")
+
+
+def create_checkin_location_history_index(db):
+    # also serves every query of the index it replaces, which would only cost writes
+    db.checkin.create_index([("suc.locationId", pymongo.ASCENDING), ("checkin.time", pymongo.DESCENDING),
+                             ("_id", pymongo.DESCENDING)])
+    db.checkin.drop_index([("suc.locationId", pymongo.ASCENDING), ("checkin.time", pymongo.DESCENDING)])
+
+
+def build_rollups(db):
+    # formerly built by the first /stats request
+    if not db.meta.find_one({'_id': 'rollups'}):
+        rollups.rebuild(db)
+
+
+def create_event_seq_index(db):
+    db.event.create_index("seq")
+
+
+def build_overview(db):
+    # formerly built by the first /overview request
+    if not db.meta.find_one({'_id': 'overview'}):
+        overview.rebuild(db)
+
+
+def create_event_seq_unique_index(db):
+    # the insert of an event claims its sequence number, see events.publish, events from before have none
+    if 'seq_1' in db.event.index_information():
+        db.event.drop_index('seq_1')
+    db.event.create_index("seq", unique=True, sparse=True)
+
+
+# append only, the position of a migration is its version
+migrations = [
+    ('indexes of suc, checkin, overview and rollup, formerly created by setup_db()', create_indexes),
+    ('capped collection of the events streamed by /events', create_event_collection),
+    ('index of the update time of overview summaries, for delta syncs of /overview', create_overview_updated_index),
+    ('index of the checkins of a location in the order of /checkin', create_checkin_location_history_index),
+    ('rollups of /stats, built from the checkins', build_rollups),
+    ('index of the sequence numbers of events, /events resumes after one of them', create_event_seq_index),
+    ('summaries of /overview, built from the checkins', build_overview),
+    ('unique index of the sequence numbers of events, inserting an event claims its number',
+     create_event_seq_unique_index),
+]
+
+
+def version(db):
+    meta = db.meta.find_one({'_id': 'schema'})
+    return meta['version'] if meta else 0
+
+
+def migrate(db):
+    """Apply the migrations newer than the version recorded in db.meta, returns the new version."""
+    current = version(db)
+    for v, (description, apply) in enumerate(migrations, 1):
+        if v > current:
+            logger.info("Migrating to version %d, %s" % (v, description))
+            apply(db)
+            db.meta.replace_one({'_id': 'schema'}, {'_id': 'schema', 'version': v}, upsert=True)
+            current = v
+    return current
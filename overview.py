@@ -0,0 +1,238 @@
+import datetime
+from datetime import timedelta
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pytz import timezone
+
+from config import setup_logging
+import jobs
+
+logger = setup_logging()
+
+tz_utc = timezone('UTC')
+
+window = timedelta(days=14)
+sweep_interval = timedelta(seconds=60)
+# changes written by other workers can become visible a bit after their updated time, sync tokens overlap by this
+sync_margin = timedelta(seconds=10)
+
+_last_sweep = None
+
+
+def utilization(submission):
+    charging = submission['checkin'].get('charging')
+    stalls = submission['suc'].get('stalls')
+    if charging is None or not stalls:
+        return None
+    return charging / stalls
+
+
+def add_checkin(db, submission):
+    """Apply a freshly inserted checkin to the per-location summary in db.overview."""
+    add_checkins(db, [submission])
+
+
+def add_checkins(db, submissions):
+    """Apply freshly inserted checkins to the per-location summaries in db.overview, in one bulk write."""
+    now_utc = tz_utc.localize(datetime.datetime.utcnow())
+    operations = []
+    for submission in submissions:
+        t = submission['checkin']['time']
+        if t is None or t <= now_utc - window or not submission['suc'].get('locationId'):
+            continue
+
+        location_id = submission['suc']['locationId']
+        u = utilization(submission)
+        operations.append(UpdateOne({'_id': location_id}, {'$inc': {
+            'checkins': 1,
+            'utilizationSum': u if u is not None else 0,
+            'utilizationCount': 1 if u is not None else 0,
+            'revision': 1,
+        }, '$set': {'updated': now_utc}}, upsert=True))
+
+        # the checkin might be older than the newest one we already have for this location
+        operations.append(UpdateOne({'_id': location_id, '$or': [{'lastCheckin': {'$lte': t}}, {'lastCheckin': None}]},
+                                    {'$set': {
+                                        'title': submission['suc']['title'],
+                                        'loc': submission['suc'].get('loc'),
+                                        'tffUserId': submission['submitter'].get('tffUserId'),
+                                        'lastCheckin': t,
+                                        # imported checkins have no problem reports
+                                        'problem': submission['checkin'].get('problem'),
+                                        'affectedStalls': submission['checkin'].get('affectedStalls'),
+                                        'notes': submission['checkin'].get('notes'),
+                                    }}))
+
+    # ordered, the upsert creates the summary before the last checkin is set on it
+    if operations:
+        db.overview.bulk_write(operations, ordered=True)
+
+
+def recompute(db, cutoff, location_ids=None, attempts=3):
+    """Recompute the summary from the checkins newer than cutoff, either for the given locations or for all.
+
+    Summaries of locations without checkins in the window are kept with zero counts, so delta syncs see them go.
+    Every write to a summary increments its revision, a summary which add_checkins changed while the checkins were
+    aggregated is not overwritten but recomputed again.
+    """
+    now_utc = tz_utc.localize(datetime.datetime.utcnow())
+    query = {'checkin.time': {'$gt': cutoff}}
+    existing = {}
+    if location_ids is not None:
+        query['suc.locationId'] = {'$in': location_ids}
+        existing['_id'] = {'$in': location_ids}
+    summaries = {o['_id']: o for o in db.overview.find(existing, {'revision': True, 'checkins': True})}
+
+    with_utilization = {'$and': [{'$gt': ['$checkin.charging', None]}, {'$gt': ['$suc.stalls', 0]}]}
+    found = set()
+    conflicts = []
+    for c in db.checkin.aggregate([
+        {'$match': query},
+        {'$sort': {'checkin.time': 1}},
+        {'$group': {'_id': '$suc.locationId',
+                    'title': {'$last': '$suc.title'},
+                    'loc': {'$last': '$suc.loc'},
+                    'checkins': {'$sum': 1},
+                    'utilizationSum': {'$sum': {'$cond': [with_utilization, {'$divide': ['$checkin.charging', '$suc.stalls']}, 0]}},
+                    'utilizationCount': {'$sum': {'$cond': [with_utilization, 1, 0]}},
+                    'tffUserId': {'$last': '$submitter.tffUserId'},
+                    'lastCheckin': {'$last': '$checkin.time'},
+                    'problem': {'$last': '$checkin.problem'},
+                    'affectedStalls': {'$last': '$checkin.affectedStalls'},
+                    'notes': {'$last': '$checkin.notes'},
+                    }
+         }
+    ]):
+        if c['_id'] is None:
+            continue
+        found.add(c['_id'])
+        c['updated'] = now_utc
+        if c['_id'] in summaries:
+            revision = summaries[c['_id']].get('revision')
+            c['revision'] = (revision or 0) + 1
+            if not db.overview.replace_one({'_id': c['_id'], 'revision': revision}, c).matched_count:
+                conflicts.append(c['_id'])
+        else:
+            c['revision'] = 1
+            try:
+                db.overview.insert_one(c)
+            except DuplicateKeyError:
+                conflicts.append(c['_id'])
+
+    for location_id, summary in summaries.items():
+        if location_id not in found and summary.get('checkins'):
+            if not db.overview.update_one({'_id': location_id, 'revision': summary.get('revision')},
+                                          {'$set': {'checkins': 0, 'utilizationSum': 0, 'utilizationCount': 0,
+                                                    'updated': now_utc},
+                                           '$inc': {'revision': 1}}).matched_count:
+                conflicts.append(location_id)
+
+    if conflicts:
+        if attempts > 1:
+            recompute(db, cutoff, conflicts, attempts - 1)
+        else:
+            logger.warn("Overview changed while recomputing, locations=%s" % conflicts)
+    return len(found)
+
+
+def rebuild(db):
+    """Recompute all summaries from the checkins, returns the number of locations or None if another rebuild is
+    running."""
+    job_id = ObjectId()
+    if not jobs.acquire(db, 'rebuild:overview', job_id):
+        logger.info("Overview is rebuilt by another process")
+        return None
+    try:
+        now_utc = tz_utc.localize(datetime.datetime.utcnow())
+        cutoff = now_utc - window
+        db.meta.replace_one({'_id': 'overview'}, {'_id': 'overview', 'windowStart': cutoff}, upsert=True)
+        count = recompute(db, cutoff)
+        logger.info("Rebuilt overview, locations=%d" % count)
+        return count
+    finally:
+        jobs.release(db, 'rebuild:overview', job_id)
+
+
+def expire(db):
+    """Drop checkins that left the window since the last sweep, only touching the locations they belong to."""
+    now_utc = tz_utc.localize(datetime.datetime.utcnow())
+    cutoff = now_utc - window
+
+    meta = db.meta.find_one({'_id': 'overview'})
+    if not meta:
+        # built by the migrations, requests only read the summaries
+        logger.warn("Overview was not built, run python manage.py migrate")
+        return
+
+    window_start = meta['windowStart']
+    # claim the slice (window_start, cutoff], other workers sweeping at the same time will not match
+    if not db.meta.find_one_and_update({'_id': 'overview', 'windowStart': window_start},
+                                       {'$set': {'windowStart': cutoff}}):
+        return
+
+    location_ids = db.checkin.distinct('suc.locationId', {'checkin.time': {'$gt': window_start, '$lte': cutoff}})
+    if location_ids:
+        recompute(db, cutoff, location_ids)
+        logger.debug("Expired overview, locations=%d" % len(location_ids))
+
+
+def last_checkins(db, location_ids):
+    """Latest checkin per location, fetched in a single round trip."""
+    return {c['_id']: c['checkin'] for c in db.checkin.aggregate([
+        {'$match': {'suc.locationId': {'$in': location_ids}}},
+        {'$sort': {'suc.locationId': 1, 'checkin.time': -1}},
+        {'$group': {'_id': '$suc.locationId', 'checkin': {'$first': '$checkin'}}},
+    ])}
+
+
+def item(c):
+    return {'locationId': c['_id'],
+            'title': c['title'],
+            'loc': {'lat': c['loc']['coordinates'][1], 'lng': c['loc']['coordinates'][0]},
+            'checkins': c['checkins'],
+            'utilization': c['utilizationSum'] / c['utilizationCount'] if c['utilizationCount'] else None,
+            'tffUserId': c['tffUserId'],
+            'lastCheckin': c['lastCheckin'],
+            'problem': c['problem'],
+            'affectedStalls': c['affectedStalls'],
+            'notes': c['notes'],
+            }
+
+
+def sweep(db):
+    global _last_sweep
+
+    now_utc = tz_utc.localize(datetime.datetime.utcnow())
+    if _last_sweep is None or now_utc - _last_sweep > sweep_interval:
+        _last_sweep = now_utc
+        expire(db)
+    return now_utc
+
+
+def read(db):
+    now_utc = sweep(db)
+    return [item(c) for c in db.overview.find({'lastCheckin': {'$gt': now_utc - window}}).sort('_id', pymongo.ASCENDING)]
+
+
+def changes(db, since):
+    """The summaries which changed since the given time and the ids of the locations which left the window since.
+
+    A location changed if a checkin arrived or its summary was written since, it left the window if its last
+    checkin aged out since or its summary was emptied since.
+    """
+    now_utc = sweep(db)
+    cutoff = now_utc - window
+    since = since - sync_margin
+
+    changed = [item(c) for c in db.overview.find({
+        'lastCheckin': {'$gt': cutoff},
+        '$or': [{'updated': {'$gt': since}}, {'lastCheckin': {'$gt': since}}],
+    }).sort('_id', pymongo.ASCENDING)]
+    removed = [c['_id'] for c in db.overview.find({
+        'lastCheckin': {'$lte': cutoff},
+        '$or': [{'updated': {'$gt': since}}, {'lastCheckin': {'$gt': since - window}}],
+    }, {'_id': True}).sort('_id', pymongo.ASCENDING)]
+    return changed, removed
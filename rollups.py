@@ -0,0 +1,121 @@
+import datetime
+from collections import defaultdict
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo import UpdateOne, UpdateMany
+from pytz import timezone
+
+from config import setup_logging
+from overview import utilization
+import jobs
+
+logger = setup_logging()
+
+tz_utc = timezone('UTC')
+
+
+def add_checkins(db, submissions):
+    """Fold stored checkins into the per-country and per-location rows of db.rollup, one unordered bulk write."""
+    increments = defaultdict(lambda: {'checkins': 0, 'utilizationSum': 0, 'utilizationCount': 0})
+    fields = {}
+    for s in submissions:
+        country = s['suc'].get('country')
+        location_id = s['suc'].get('locationId')
+        rows = []
+        if country:
+            rows.append(('country:%s' % country, {'kind': 'country', 'country': country}))
+        if location_id:
+            rows.append(('location:%s' % location_id, {'kind': 'location', 'country': country, 'locationId': location_id}))
+
+        u = utilization(s)
+        for key, row in rows:
+            fields[key] = row
+            increments[key]['checkins'] += 1
+            if u is not None:
+                increments[key]['utilizationSum'] += u
+                increments[key]['utilizationCount'] += 1
+
+    if increments:
+        db.rollup.bulk_write([UpdateOne({'_id': key}, {'$inc': inc, '$set': fields[key]}, upsert=True)
+                              for key, inc in increments.items()], ordered=False)
+
+
+def update_sucs(db, collection=None):
+    """Store the number of superchargers per country, called whenever the catalog changed."""
+    collection = collection if collection is not None else db.rollup
+    sucs = {r['_id']: r['sucs'] for r in db.suc.aggregate([
+        {'$match': {'type': 'supercharger'}},
+        {'$group': {'_id': '$country', 'sucs': {'$sum': 1}}}
+    ]) if r['_id']}
+
+    operations = [UpdateOne({'_id': 'country:%s' % country}, {'$set': {'kind': 'country', 'country': country, 'sucs': count}},
+                            upsert=True)
+                  for country, count in sucs.items()]
+    operations.append(UpdateMany({'kind': 'country', 'country': {'$nin': list(sucs.keys())}}, {'$set': {'sucs': 0}}))
+    collection.bulk_write(operations, ordered=False)
+
+
+def rebuild(db):
+    """Recompute all rollups from the checkin and suc collections, returns the number of rows or None if another
+    rebuild is running.
+
+    The rows are built in a staging collection which then replaces db.rollup, readers never see a partial table.
+    Checkins stored while the rows were built are folded in again after the switch.
+    """
+    job_id = ObjectId()
+    if not jobs.acquire(db, 'rebuild:rollups', job_id):
+        logger.info("Rollups are rebuilt by another process")
+        return None
+    try:
+        started = tz_utc.localize(datetime.datetime.utcnow())
+        with_utilization = {'$and': [{'$gt': ['$checkin.charging', None]}, {'$gt': ['$suc.stalls', 0]}]}
+        group = {'checkins': {'$sum': 1},
+                 'utilizationSum': {'$sum': {'$cond': [with_utilization, {'$divide': ['$checkin.charging', '$suc.stalls']}, 0]}},
+                 'utilizationCount': {'$sum': {'$cond': [with_utilization, 1, 0]}}}
+        # imported checkins can lack a submitter time, they count as stored before
+        before = {'submitter.time': {'$not': {'$gte': started}}}
+
+        rows = []
+        for r in db.checkin.aggregate([{'$match': dict(before, **{'suc.country': {'$ne': None}})},
+                                       {'$group': dict(group, _id='$suc.country')}]):
+            rows.append(dict(r, _id='country:%s' % r['_id'], kind='country', country=r['_id'], sucs=0))
+        for r in db.checkin.aggregate([{'$match': dict(before, **{'suc.locationId': {'$ne': None}})},
+                                       {'$group': dict(group, _id='$suc.locationId', country={'$last': '$suc.country'})}]):
+            rows.append(dict(r, _id='location:%s' % r['_id'], kind='location', locationId=r['_id']))
+
+        staging = db.rollup_staging
+        staging.drop()
+        staging.create_index([("kind", pymongo.ASCENDING), ("country", pymongo.ASCENDING)])
+        if rows:
+            staging.insert_many(rows)
+        update_sucs(db, staging)
+
+        staging.rename('rollup', dropTarget=True)
+        switched = tz_utc.localize(datetime.datetime.utcnow())
+        # the increments of these went to the replaced collection, only those stored at the moment of the switch
+        # can be counted twice
+        add_checkins(db, list(db.checkin.find({'submitter.time': {'$gte': started, '$lte': switched}})))
+
+        db.meta.replace_one({'_id': 'rollups'}, {'_id': 'rollups', 'rows': len(rows)}, upsert=True)
+        logger.info("Rebuilt rollups, rows=%d" % len(rows))
+        return len(rows)
+    finally:
+        jobs.release(db, 'rebuild:rollups', job_id)
+
+
+def average(row):
+    return row['utilizationSum'] / row['utilizationCount'] if row.get('utilizationCount') else None
+
+
+def countries(db):
+    return [{'country': r['country'],
+             'sucs': r.get('sucs', 0),
+             'checkins': r['checkins'],
+             'utilization': average(r)}
+            for r in db.rollup.find({'kind': 'country', 'checkins': {'$gt': 0}}).sort('country')]
+
+
+def locations(db, country):
+    return {r['locationId']: {'checkins': r['checkins'], 'utilization': average(r)}
+            for r in db.rollup.find({'kind': 'location', 'country': country})}
@@ -1,11 +1,25 @@
+import codecs
+import hashlib
 import json
 import requests
 import re
 import datetime
+from time import monotonic
+from pymongo import InsertOne, ReplaceOne, DeleteMany
 from pymongo.errors import DuplicateKeyError, BulkWriteError
 from pytz import timezone
 
 from config import setup_logging, setup_db
+from lib import parse_json_array
+from search import SearchIndex
+import catalog
+import data_version
+import events
+import metrics
+import history
+import overview
+import rollups
+import snapshot
 
 logger = setup_logging()
 
@@ -16,7 +30,7 @@ tz_zurich = timezone('Europe/Zurich')
 tz_utc = timezone('UTC')
 
 
-def chargers(s, location_id):
+def chargers(s, location_id=None):
     m = pattern_suc.findall(s)
     if len(m) > 0:
         return int(m[0])
@@ -29,82 +43,201 @@ def chargers(s, location_id):
     return None
 
 
-def import_from_url(url, type, suc_collection, truncate):
-    res = requests.get(url, headers={
+def location_document(r, type):
+    d = {
+        'type': type,
+        'locationId': r['location_id'],
+        'title': r['title'],
+        'country': r['country'],
+        'raw': r,
+    }
+    if 'chargers' in r and r['chargers']:
+        d['stalls'] = chargers(r['chargers'], r['location_id'])
+    else:
+        logger.warn("No chargers for %s" % r['location_id'])
+        d['stalls'] = None
+
+    if 'latitude' in r and 'longitude' in r:
+        lat = float(r['latitude'])
+        lng = float(r['longitude'])
+        d['loc'] = {'type': "Point", 'coordinates': [lng, lat]}
+
+    d['hash'] = content_hash(d)
+    return d
+
+
+def timed(iterable, timings, stage):
+    """Adds the time spent producing each item of iterable to timings[stage]."""
+    iterator = iter(iterable)
+    while True:
+        start = monotonic()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[stage] += monotonic() - start
+            return
+        timings[stage] += monotonic() - start
+        yield item
+
+
+def import_from_url(url, type, suc_collection, truncate, progress=None, batch_size=500):
+    """Stream the location list from url into the catalog, writing only what changed.
+
+    Locations are parsed one at a time and written in batches of batch_size operations, so memory stays flat
+    however long the list is. Locations missing from the list are removed when truncate is set and the whole
+    list could be read.
+    """
+    started = monotonic()
+    timings = {'download': 0.0, 'parse': 0.0, 'normalize': 0.0, 'write': 0.0}
+    res = requests.get(url, stream=True, headers={
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.12; rv:59.0) Gecko/20100101 Firefox/59.0'
     })
     if res.status_code != 200:
-        logger.error('Failed to load type=%s, code=%d, url=%s, res=%s' % (type, res.status_code, url, res.text))
+        logger.error('Failed to load type=%s, code=%d, url=%s' % (type, res.status_code, url))
 
-    log_line = 'parsing type=%s, code=%d, url=%s, len=%d, text=%s' % (type, res.status_code, url, len(res.text), res.text[:50])
+    log_line = 'parsing type=%s, code=%d, url=%s, len=%s' % (type, res.status_code, url, res.headers.get('Content-Length'))
     logger.debug(log_line)
-    try:
-        results = json.loads(res.text)
-    except json.decoder.JSONDecodeError:
-        return res.text
-
-    if truncate:
-        suc_collection.remove()
-
-    inserted = 0
-    failed = 0
-    skipped = 0
-    documents = []
-    duplicates = {}
-    for r in results:
-        if 'location_id' not in r:
-            logger.warn("No location_id for %s" % str(r))
-            skipped += 1
-            continue
-
-        if 'open_soon' in r and r['open_soon'] == '1':
-            logger.info("Skip open_soon for %s" % r['location_id'])
-            skipped += 1
-            continue
-
-        if r['location_id'] in duplicates:
-            logger.info("Skip duplicates for %s" % r['location_id'])
-            skipped += 1
-            continue
-        duplicates[r['location_id']] = True
-
-        d = {
-            'type': type,
-            'locationId': r['location_id'],
-            'title': r['title'],
-            'country': r['country'],
-            'raw': r,
-        }
-        if 'chargers' in r and r['chargers']:
-            d['stalls'] = chargers(r['chargers'], r['location_id'])
-        else:
-            logger.warn("No chargers for %s" % r['location_id'])
-            d['stalls'] = None
 
-        if 'latitude' in r and 'longitude' in r:
-            lat = float(r['latitude'])
-            lng = float(r['longitude'])
-            d['loc'] = {'type': "Point", 'coordinates': [lng, lat]}
+    decoder = codecs.getincrementaldecoder(res.encoding or 'utf-8')(errors='replace')
+    chunks = timed((decoder.decode(c) for c in res.iter_content(chunk_size=64 * 1024)), timings, 'download')
+    records = timed(parse_json_array(chunks), timings, 'parse')
+
+    # only write what changed, the catalog stays complete for readers while the import runs
+    existing = {}
+    countries = {}
+    for s in suc_collection.find({'type': type}, {'locationId': True, 'hash': True, 'country': True}):
+        existing[s['locationId']] = s.get('hash')
+        countries[s['locationId']] = s.get('country')
+
+    result = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'removed': 0, 'failed': 0, 'skipped': 0, 'logLine': log_line}
+    count = 0
+    seen = set()
+    operations = []
+    # the events to publish for each operation, once it was written
+    changes = []
+
+    def flush():
+        if not operations:
+            return
+        start = monotonic()
+        failed = set()
+        try:
+            details = suc_collection.bulk_write(operations, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            logger.error(str(e))
+            details = e.details
+            failed = {error['index'] for error in e.details['writeErrors']}
+            result['failed'] += len(e.details['writeErrors'])
+            result['error'] = str(e)
+            result['errorDetails'] = str(e.details)
+        result['inserted'] += details['nInserted']
+        result['updated'] += details['nModified']
+        result['removed'] += details['nRemoved']
+        events.publish(suc_collection.database, [e for i, c in enumerate(changes) if i not in failed for e in c])
+        del operations[:]
+        del changes[:]
+        timings['write'] += monotonic() - start
+        if progress:
+            progress('write', locations=count, **{k: result[k] for k in ('inserted', 'updated', 'unchanged', 'removed')})
 
-        documents.append(d)
-        #try:
-        #    suc_collection.insert(d)
-        #    inserted += 1
-        #except DuplicateKeyError:
-        #    logger.warn("Duplicated key=%s" % d['locationId'])
-        #    failed += 1
     try:
-        suc_collection.insert_many(documents)
-        logger.info("Imported, type=%s, count=%d" % (type, len(results)))
-        return {'inserted': len(documents), 'failed': 0, 'skipped': skipped, 'logLine': log_line}
-    except BulkWriteError as e:
-        logger.error(str(e))
-        return {'inserted': 0, 'failed': len(documents), 'skipped': skipped, 'logLine': log_line, 'error': str(e), 'errorDetails': str(e.details)}
-
-
-def import_checkins(data, suc_collection, checkin_collection):
+        try:
+            for r in records:
+                count += 1
+                start = monotonic()
+                if 'location_id' not in r:
+                    logger.warn("No location_id for %s" % str(r))
+                    result['skipped'] += 1
+                    continue
+
+                if 'open_soon' in r and r['open_soon'] == '1':
+                    logger.info("Skip open_soon for %s" % r['location_id'])
+                    result['skipped'] += 1
+                    continue
+
+                if r['location_id'] in seen:
+                    logger.info("Skip duplicates for %s" % r['location_id'])
+                    result['skipped'] += 1
+                    continue
+                seen.add(r['location_id'])
+
+                try:
+                    d = location_document(r, type)
+                except (ValueError, TypeError, KeyError) as e:
+                    # e.g. an empty latitude, the stored document is kept as it is
+                    logger.warn("Invalid location %s, error=%s" % (r['location_id'], str(e)))
+                    result['failed'] += 1
+                    continue
+                if d['locationId'] not in existing:
+                    operations.append(InsertOne(d))
+                    changes.append([events.location_event('inserted', d)])
+                elif existing[d['locationId']] != d['hash']:
+                    operations.append(ReplaceOne({'type': type, 'locationId': d['locationId']}, d))
+                    changes.append([events.location_event('updated', d)])
+                else:
+                    result['unchanged'] += 1
+                timings['normalize'] += monotonic() - start
+
+                if len(operations) >= batch_size:
+                    flush()
+        except ValueError as e:
+            # keep what was written so far, but do not remove anything based on an incomplete list
+            logger.error("Failed to parse type=%s, url=%s, error=%s" % (type, url, str(e)))
+            result['error'] = str(e)
+            truncate = False
+        finally:
+            res.close()
+
+        removed = [location_id for location_id in existing if location_id not in seen] if truncate else []
+        if removed:
+            operations.append(DeleteMany({'type': type, 'locationId': {'$in': removed}}))
+            changes.append([events.location_event('removed', {'type': type, 'locationId': location_id,
+                                                               'country': countries[location_id]})
+                            for location_id in removed])
+        flush()
+    finally:
+        if result['inserted'] or result['updated'] or result['removed']:
+            catalog.invalidate(suc_collection.database)
+            rollups.update_sucs(suc_collection.database)
+            data_version.bump(suc_collection.database)
+
+    # parsing pulls the chunks, so its time includes the download
+    timings['parse'] -= timings['download']
+    result['timings'] = timings
+    metrics.observe_import(type, result, monotonic() - started)
+    logger.info("Imported, type=%s, count=%d, inserted=%d, updated=%d, unchanged=%d, removed=%d, failed=%d, timings=%s"
+                % (type, count, result['inserted'], result['updated'], result['unchanged'], result['removed'], result['failed'], timings))
+    return result
+
+
+def content_hash(d):
+    return hashlib.sha1(json.dumps(d, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class SuperChargerMatcher:
+    """Resolves the free text supercharger names of the legacy checkin CSV against the european superchargers.
+
+    A name matches a supercharger if it is a case and accent insensitive substring of its title, locationId or
+    common name. Results are memoized since the same names repeat throughout an import.
+    """
+    def __init__(self, suc_collection):
+        self.index = SearchIndex(((s.get('title'), s.get('locationId'), s.get('raw', {}).get('common_name')), s)
+                                 for s in suc_collection.find({'type': 'supercharger', 'raw.region': 'europe'},
+                                                              {'locationId': True, 'title': True, 'country': True,
+                                                               'loc': True, 'raw.common_name': True}))
+        self.matches = {}
+
+    def match(self, text):
+        if text not in self.matches:
+            self.matches[text] = self.index.matches(text)
+        return self.matches[text]
+
+
+def import_checkins(data, suc_collection, checkin_collection, batch_size=1000):
+    start = monotonic()
     post_data = filter(None, data.split("\n"))
     items = [d.split(",") for d in post_data]
+    matcher = SuperChargerMatcher(suc_collection)
 
     def parse(item):
         error = None
@@ -113,15 +246,7 @@ def import_checkins(data, suc_collection, checkin_collection):
             error = 'len=' + str(len(item))
 
         text = item[2]
-        sucs = [s for s in suc_collection.find({
-            '$and': [{'type': 'supercharger', 'raw.region': 'europe'}, {
-                '$or': [
-                    {'title': {'$regex': re.escape(text), '$options': '-i'}},
-                    {'locationId': {'$regex': re.escape(text), '$options': '-i'}},
-                    {'raw.common_name': {'$regex': re.escape(text), '$options': '-i'}},
-                ]
-            }]
-            })]
+        sucs = matcher.match(text)
         if len(sucs) != 1:
             error = 'Invalid supercharger, len=%d' % len(sucs)
             suc = {'locationId': None, 'title': text, 'country': None}
@@ -156,6 +281,7 @@ def import_checkins(data, suc_collection, checkin_collection):
                 'title': suc['title'],
                 'country': suc['country'],
                 'stalls': int(item[3]),
+                'loc': suc.get('loc'),
             },
             'checkin': {
                 'time': time,
@@ -172,20 +298,67 @@ def import_checkins(data, suc_collection, checkin_collection):
             },
             'error': error,
         }
-    parsed = list(filter(None, [parse(i) for i in items]))
-    for item in parsed:
-        checkin_collection.insert(item)
-    return len(parsed)
 
+    errors = []
+    documents = []
+    lines = []
+    for line, item in enumerate(items, start=1):
+        try:
+            d = parse(item)
+        except (IndexError, ValueError) as e:
+            errors.append({'line': line, 'error': 'Unparsable row: ' + str(e)})
+            continue
+        if d['error']:
+            # kept for later review, like the rows which could be parsed
+            errors.append({'line': line, 'error': d['error']})
+        documents.append(d)
+        lines.append(line)
 
-def run_import_suc(suc_collection):
+    inserted = 0
+    for i in range(0, len(documents), batch_size):
+        batch = documents[i:i + batch_size]
+        try:
+            inserted += len(checkin_collection.insert_many(batch, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            inserted += e.details['nInserted']
+            failed = set()
+            for write_error in e.details['writeErrors']:
+                failed.add(write_error['index'])
+                errors.append({'line': lines[i + write_error['index']], 'error': write_error['errmsg']})
+            batch = [d for j, d in enumerate(batch) if j not in failed]
+        # rows which could not be resolved to a location are only kept for review
+        resolved = [d for d in batch if d['suc']['locationId'] and d['checkin']['time']]
+        overview.add_checkins(checkin_collection.database, resolved)
+        rollups.add_checkins(checkin_collection.database, batch)
+        events.publish(checkin_collection.database, events.checkin_events(resolved))
+
+    if inserted:
+        history.invalidate(checkin_collection.database)
+        data_version.bump(checkin_collection.database)
+
+    duration = monotonic() - start
+    logger.info("Imported checkins, rows=%d, inserted=%d, errors=%d, duration=%.3fs" % (len(items), inserted, len(errors), duration))
+    return {
+        'rows': len(items),
+        'imported': inserted,
+        'errors': sorted(errors, key=lambda e: e['line']),
+        'duration': duration,
+        'rowsPerSecond': len(items) / duration if duration > 0 else None,
+    }
+
+
+def run_import_suc(suc_collection, progress=None):
     logger.info("Importing, previous suc_collection_count=%d" % suc_collection.count())
-    return import_from_url('https://www.tesla.com/all-locations?type=supercharger', 'supercharger', suc_collection, True)
+    result = import_from_url('https://www.tesla.com/all-locations?type=supercharger', 'supercharger', suc_collection, True, progress)
+    result['snapshotVersion'] = snapshot.generate(suc_collection.database)
+    return result
 
 
-def run_import_dec(suc_collection):
+def run_import_dec(suc_collection, progress=None):
     logger.info("Importing, previous suc_collection_count=%d" % suc_collection.count())
-    return import_from_url('https://www.tesla.com/all-locations?type=destination_charger', 'destination_charger', suc_collection, False)
+    result = import_from_url('https://www.tesla.com/all-locations?type=destination_charger', 'destination_charger', suc_collection, False, progress)
+    result['snapshotVersion'] = snapshot.generate(suc_collection.database)
+    return result
 
 
 if __name__ == "__main__":
@@ -0,0 +1,97 @@
+import heapq
+import re
+import unicodedata
+from collections import defaultdict
+
+gram_size = 3
+# type-ahead queries repeat a lot, results of the most recent ones are kept
+max_cached_queries = 1024
+token_pattern = re.compile(r'\w+')
+
+
+def fold(s):
+    """Case and accent folded form of s, 'Zürich' and 'ZURICH' both become 'zurich'."""
+    return ''.join(c for c in unicodedata.normalize('NFKD', s) if not unicodedata.combining(c)).casefold()
+
+
+def grams(s):
+    return {s[i:i + gram_size] for i in range(len(s) - gram_size + 1)}
+
+
+class SearchIndex:
+    """Substring search with ranked results over a few short texts per value, e.g. title, locationId and common name.
+
+    Every folded text is indexed by its character trigrams and its tokens by their prefixes shorter than a trigram,
+    so a query only verifies the values which contain all trigrams of the query.
+    """
+    def __init__(self, items):
+        """items is an iterable of (texts, value), the first text is the name used to break ties."""
+        self.values = []
+        self.texts = []
+        self.tokens = []
+        self.grams = defaultdict(set)
+        self.prefixes = defaultdict(set)
+        self.results = {}
+
+        for i, (texts, value) in enumerate(items):
+            folded = [fold(t) for t in texts if t] or ['']
+            tokens = [token for t in folded for token in token_pattern.findall(t)]
+            self.values.append(value)
+            self.texts.append(folded)
+            self.tokens.append(tokens)
+            for t in folded:
+                for g in grams(t):
+                    self.grams[g].add(i)
+            for token in tokens:
+                for n in range(1, min(len(token), gram_size - 1) + 1):
+                    self.prefixes[token[:n]].add(i)
+
+    def __len__(self):
+        return len(self.values)
+
+    def _candidates(self, q):
+        if len(q) < gram_size:
+            return self.prefixes.get(q, set())
+        sets = sorted((self.grams.get(g, set()) for g in grams(q)), key=len)
+        return set.intersection(*sets)
+
+    def _score(self, i, q):
+        texts = self.texts[i]
+        if q in texts:
+            return 5
+        if texts[0].startswith(q):
+            return 4
+        if any(t.startswith(q) for t in texts):
+            return 3
+        if any(token.startswith(q) for token in self.tokens[i]):
+            return 2
+        if any(q in t for t in texts):
+            return 1
+        return 0
+
+    def search(self, query, limit=20):
+        """Values matching query, best first: exact match, name prefix, text prefix, word prefix, then any substring."""
+        q = fold(query).strip()
+        if not q:
+            return []
+        if (q, limit) in self.results:
+            return self.results[(q, limit)]
+
+        ranked = []
+        for i in self._candidates(q):
+            score = self._score(i, q)
+            if score:
+                name = self.texts[i][0]
+                ranked.append((-score, len(name), name, i))
+        results = [self.values[r[3]] for r in heapq.nsmallest(limit, ranked)]
+
+        if len(self.results) >= max_cached_queries:
+            self.results.clear()
+        self.results[(q, limit)] = results
+        return results
+
+    def matches(self, query):
+        """All values containing query in one of their texts, in index order."""
+        q = fold(query)
+        candidates = self._candidates(q) if len(q) >= gram_size else range(len(self.values))
+        return [self.values[i] for i in sorted(candidates) if any(q in t for t in self.texts[i])]
@@ -0,0 +1,41 @@
+import datetime
+import json
+
+from bson.objectid import ObjectId
+from flask import Response
+
+from lib import TimeFormat
+
+
+def format_time(t):
+    """t.strftime(TimeFormat), isoformat() gives the same for naive times in about half the time."""
+    if t.tzinfo is None and t.year >= 1000:
+        return t.isoformat(timespec='microseconds') + 'Z'
+    return t.strftime(TimeFormat)
+
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        # called for every datetime of a response, the common case is checked first
+        if type(o) is datetime.datetime and o.tzinfo is None and o.year >= 1000:
+            return o.isoformat(timespec='microseconds') + 'Z'
+        elif isinstance(o, datetime.datetime):
+            return format_time(o)
+        elif isinstance(o, ObjectId):
+            return str(o)
+        return json.JSONEncoder.default(self, o)
+
+
+# one encoder for all responses, json.dumps(cls=...) and jsonify build a new one per call
+_compact = JSONEncoder(separators=(',', ':'), sort_keys=True)
+
+
+def dumps(o):
+    """Compact, key sorted json, the same as jsonify writes without its trailing newline."""
+    return _compact.encode(o)
+
+
+def response(o, status=200, headers=None):
+    """A json response like jsonify(o), o can also be the bytes of a response encoded before."""
+    body = o if isinstance(o, bytes) else (dumps(o) + '\n').encode('utf-8')
+    return Response(body, status=status, headers=headers, mimetype='application/json')
@@ -0,0 +1,128 @@
+"""Compact, versioned snapshots of the catalog for clients which keep a copy of it, e.g. offline or at the edge.
+
+A snapshot is gzipped JSON with one array per column, rows sorted by type and locationId so clients can binary
+search them. Type and country are dictionary encoded. The gzipped bytes are stored in db.snapshot and served as
+they are, a new version is only written when the catalog changed.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+
+import pymongo
+from pymongo import ReturnDocument
+from pytz import timezone
+
+from cache import LruCache
+from config import setup_logging
+from lib import TimeFormat
+
+logger = setup_logging()
+
+tz_utc = timezone('UTC')
+
+columns = ['locationId', 'title', 'country', 'stalls', 'lat', 'lng', 'type']
+# older versions are dropped, clients with an older copy download the whole snapshot again
+max_snapshots = 10
+
+# versions never change, decoded snapshots are kept per process to compute diffs
+_decoded = LruCache(max_size=4, ttl=3600)
+
+
+def rows(db):
+    return [{'locationId': s['locationId'],
+             'title': s.get('title'),
+             'country': s.get('country'),
+             'stalls': s.get('stalls'),
+             'lat': s['loc']['coordinates'][1] if s.get('loc') else None,
+             'lng': s['loc']['coordinates'][0] if s.get('loc') else None,
+             'type': s['type'],
+             }
+            for s in db.suc.find({}, {'_id': False, 'locationId': True, 'title': True, 'country': True,
+                                      'stalls': True, 'loc': True, 'type': True})
+            .sort([('type', pymongo.ASCENDING), ('locationId', pymongo.ASCENDING)])]
+
+
+def pack(version, created, rows):
+    types = sorted({r['type'] for r in rows})
+    countries = sorted({r['country'] for r in rows if r['country']})
+    type_index = {t: i for i, t in enumerate(types)}
+    country_index = {c: i for i, c in enumerate(countries)}
+    packed = {c: [r[c] for r in rows] for c in columns}
+    packed['type'] = [type_index[t] for t in packed['type']]
+    packed['country'] = [country_index.get(c) for c in packed['country']]
+    return {'version': version,
+            'created': created.strftime(TimeFormat),
+            'count': len(rows),
+            'types': types,
+            'countries': countries,
+            'columns': packed,
+            }
+
+
+def unpack(snapshot):
+    packed = snapshot['columns']
+    result = []
+    for i in range(snapshot['count']):
+        r = {c: packed[c][i] for c in columns}
+        r['type'] = snapshot['types'][r['type']]
+        r['country'] = snapshot['countries'][r['country']] if r['country'] is not None else None
+        result.append(r)
+    return result
+
+
+def content_hash(rows):
+    return hashlib.sha1(json.dumps(rows, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def generate(db):
+    """Store a snapshot of the catalog if it differs from the latest one, returns the latest version."""
+    current = rows(db)
+    h = content_hash(current)
+    latest = db.snapshot.find_one({}, {'hash': True}, sort=[('_id', pymongo.DESCENDING)])
+    if latest and latest['hash'] == h:
+        return latest['_id']
+
+    version = db.meta.find_one_and_update({'_id': 'snapshot'}, {'$inc': {'version': 1}}, upsert=True,
+                                          return_document=ReturnDocument.AFTER)['version']
+    created = tz_utc.localize(datetime.datetime.utcnow())
+    data = gzip.compress(json.dumps(pack(version, created, current), separators=(',', ':')).encode('utf-8'))
+    db.snapshot.insert_one({'_id': version, 'created': created, 'hash': h, 'count': len(current), 'data': data})
+    db.snapshot.delete_many({'_id': {'$lte': version - max_snapshots}})
+    logger.info("Stored catalog snapshot, version=%d, count=%d, bytes=%d" % (version, len(current), len(data)))
+    return version
+
+
+def latest_version(db):
+    latest = db.snapshot.find_one({}, {'_id': True}, sort=[('_id', pymongo.DESCENDING)])
+    return latest['_id'] if latest else None
+
+
+def load(db, version):
+    """The stored document of a version, with the gzipped snapshot in data, or None if it is not kept."""
+    return db.snapshot.find_one({'_id': version})
+
+
+def decoded(db, version):
+    """Rows of a version by (type, locationId), or None if it is not kept."""
+    found = _decoded.get(version)
+    if found is None:
+        stored = load(db, version)
+        if not stored:
+            return None
+        found = {(r['type'], r['locationId']): r for r in unpack(json.loads(gzip.decompress(stored['data']).decode('utf-8')))}
+        _decoded.put(version, found)
+    return found
+
+
+def diff(db, old_version, new_version):
+    """Rows added or changed and the keys of the rows removed between two versions, None if one is not kept."""
+    old = decoded(db, old_version)
+    new = decoded(db, new_version)
+    if old is None or new is None:
+        return None
+    return {'from': old_version,
+            'to': new_version,
+            'changed': [r for key, r in sorted(new.items()) if old.get(key) != r],
+            'removed': [{'type': key[0], 'locationId': key[1]} for key in sorted(old) if key not in new],
+            }
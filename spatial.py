@@ -0,0 +1,105 @@
+import heapq
+import math
+
+earth_radius = 6371008.8
+
+
+def to_xyz(lat, lng):
+    lat, lng = math.radians(lat), math.radians(lng)
+    return math.cos(lat) * math.cos(lng), math.cos(lat) * math.sin(lng), math.sin(lat)
+
+
+def chord(distance):
+    """Straight line distance through the unit sphere for a great circle distance in meters."""
+    return 2 * math.sin(min(distance / earth_radius, math.pi) / 2)
+
+
+def arc(chord_length):
+    return 2 * math.asin(min(chord_length / 2, 1.0)) * earth_radius
+
+
+class KdTree:
+    """k-d tree over points on the unit sphere.
+
+    Points are stored as 3d unit vectors, the euclidean (chord) distance between two of them grows monotonically
+    with their great circle distance, so radius and nearest neighbour queries need no special casing at the poles
+    or the antimeridian.
+    """
+    def __init__(self, items):
+        """items is an iterable of (lat, lng, value)."""
+        self.points = [(to_xyz(lat, lng), value) for lat, lng, value in items]
+        self.root = self._build(list(range(len(self.points))), 0)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _build(self, indices, depth):
+        if not indices:
+            return None
+        axis = depth % 3
+        indices.sort(key=lambda i: self.points[i][0][axis])
+        median = len(indices) // 2
+        return (indices[median], axis,
+                self._build(indices[:median], depth + 1),
+                self._build(indices[median + 1:], depth + 1))
+
+    def within(self, lat, lng, radius):
+        """Values within radius meters, as (distance, value) sorted by distance."""
+        target = to_xyz(lat, lng)
+        limit = chord(radius)
+        limit_squared = limit * limit
+        found = []
+
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            index, axis, left, right = node
+            point, value = self.points[index]
+            d = _distance_squared(point, target)
+            if d <= limit_squared:
+                found.append((d, index))
+            delta = target[axis] - point[axis]
+            stack.append(left if delta <= 0 else right)
+            if abs(delta) <= limit:
+                stack.append(right if delta <= 0 else left)
+
+        found.sort()
+        return [(arc(math.sqrt(d)), self.points[i][1]) for d, i in found]
+
+    def nearest(self, lat, lng, k, radius=None):
+        """The k values closest to the given point, optionally only within radius meters, sorted by distance."""
+        target = to_xyz(lat, lng)
+        bound = chord(radius) ** 2 if radius is not None else float('inf')
+        heap = []  # max heap of the best k as (-distance, -index)
+
+        def visit(node):
+            if node is None:
+                return
+            index, axis, left, right = node
+            point, value = self.points[index]
+            d = _distance_squared(point, target)
+            if d <= bound:
+                if len(heap) < k:
+                    heapq.heappush(heap, (-d, -index))
+                elif d < -heap[0][0]:
+                    heapq.heapreplace(heap, (-d, -index))
+
+            delta = target[axis] - point[axis]
+            near, far = (left, right) if delta <= 0 else (right, left)
+            visit(near)
+            worst = -heap[0][0] if len(heap) == k else bound
+            if delta * delta <= worst:
+                visit(far)
+
+        if k > 0:
+            visit(self.root)
+        return [(arc(math.sqrt(-d)), self.points[-i][1]) for d, i in sorted(heap, reverse=True)]
+
+
+def _distance_squared(a, b):
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    dz = a[2] - b[2]
+    return dx * dx + dy * dy + dz * dz
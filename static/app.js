@@ -272,19 +272,84 @@ angular.module("myApp", ['ngRoute', 'ngCookies', 'ngMaterial', 'gettext', 'suc.c
     }
 })
 
-.controller('overviewController', function($scope, $q, $log, $http, $window, toaster) {
+.controller('overviewController', function($scope, $q, $log, $http, $window, $interval, toaster) {
     $scope.sucOverview = [];
+    var token;
 
     $scope.loading = true;
     $http.get('/overview').then(function successCallback(response) {
         $scope.loading = false;
         $scope.sucOverview = response.data;
+        token = response.headers('X-Sync-Token');
     }, function errorCallback(response) {
         $scope.loading = false;
         $log.error(response);
     });
 
+    // without a stream, only the summaries which changed since the last response are fetched every minute
+    var refresh;
+    function poll() {
+        if (refresh != undefined) {
+            return;
+        }
+        refresh = $interval(function() {
+            if (token == undefined) {
+                return;
+            }
+            $http.get('/overview', {params: {since: token}}).then(function successCallback(response) {
+                var changed = {};
+                response.data.changed.forEach(function(s) { changed[s.locationId] = s; });
+                $scope.sucOverview = $scope.sucOverview.filter(function(s) {
+                    return response.data.removed.indexOf(s.locationId) == -1 && !(s.locationId in changed);
+                }).concat(response.data.changed);
+                token = response.data.token;
+            }, function errorCallback(response) {
+                $log.error(response);
+            });
+        }, 60000);
+    }
 
+    // new checkins are pushed instead of fetching the whole overview again
+    var source;
+    if ($window.EventSource) {
+        source = new $window.EventSource('/events');
+        source.onmessage = function(message) {
+            var e = JSON.parse(message.data);
+            if (e.type != 'checkin') {
+                return;
+            }
+            $scope.$apply(function() {
+                var item = $scope.sucOverview.find(function(s) { return s.locationId == e.locationId; });
+                if (item == undefined) {
+                    item = {locationId: e.locationId, checkins: 0, utilization: null};
+                    $scope.sucOverview.push(item);
+                }
+                if (item.lastCheckin == undefined || item.lastCheckin <= e.time) {
+                    angular.extend(item, {title: e.title, loc: e.loc, tffUserId: e.tffUserId, lastCheckin: e.time,
+                                          problem: e.problem, affectedStalls: e.affectedStalls, notes: e.notes});
+                }
+                item.checkins += 1;
+            });
+        };
+        source.onerror = function() {
+            // the browser reconnects by itself unless the stream was refused, e.g. with a 503 when the server
+            // has too many streams open
+            if (source.readyState == $window.EventSource.CLOSED) {
+                poll();
+            }
+        };
+    } else {
+        poll();
+    }
+
+    $scope.$on('$destroy', function() {
+        if (source != undefined) {
+            source.close();
+        }
+        if (refresh != undefined) {
+            $interval.cancel(refresh);
+        }
+    });
 })
 
 .controller('checkinController', function($scope, $q, $log, $http, $window, $routeParams, $cookies, toaster) {
@@ -443,7 +508,7 @@ angular.module("myApp", ['ngRoute', 'ngCookies', 'ngMaterial', 'gettext', 'suc.c
 
     $scope.loadSuperCharger = function() {
         $scope.loading = true;
-        $http.get('/stats/superCharger/' + $scope.$parent.superCharger).then(function successCallback(response) {
+        $http.get('/stats/superCharger/' + $scope.$parent.superCharger + '?resolution=day').then(function successCallback(response) {
             $scope.loading = false;
             $scope.superChargerTitle = response.data.title;
             if ($scope.$parent.country != response.data.country) {
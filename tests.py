@@ -1,7 +1,138 @@
+import os
+import json
+import math
+import random
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest import mock
 import datetime
-from lib import TimePattern, TimeFormat
-from run_import import chargers, pattern_suc
+import gzip
+from datetime import timedelta
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from bson.objectid import ObjectId
+from flask import Flask, jsonify
+from werkzeug.datastructures import Accept
+from prometheus_client import REGISTRY
+from pymongo import MongoClient, monitoring
+from pytz import timezone
+
+from lib import TimePattern, TimeFormat, convert_to_csv, iter_csv, format_cursor, parse_cursor, parse_json_array
+from run_import import chargers, pattern_suc, import_checkins, import_from_url, location_document
+from cache import LruCache, VersionedCache
+from search import SearchIndex, fold
+from spatial import KdTree, earth_radius
+import overview
+import jobs
+import rollups
+import history
+import catalog
+import data_version
+import metrics
+import ingest
+import serialize
+import migrations
+import assets
+import events
+import snapshot
+import benchmark
+
+tz_utc = timezone('UTC')
+
+# tests which need a database run against a scratch MongoDB, e.g. mongodb://localhost/teslasuc_test
+test_mongodb_uri = os.getenv('TESLASUC_TEST_MONGODB_URI', None)
+
+
+def make_submission(location_id, time, charging=None, stalls=8, problem='none', title=None):
+    return {
+        'suc': {
+            'locationId': location_id,
+            'title': title or location_id.title(),
+            'country': 'CH',
+            'stalls': stalls,
+            'loc': {'type': "Point", 'coordinates': [8.5, 47.4]},
+        },
+        'submitter': {
+            'userAgent': None,
+            'ip': None,
+            'time': tz_utc.localize(datetime.datetime.utcnow()),
+            'tffUserId': 'tester',
+        },
+        'checkin': {
+            'time': time,
+            'charging': charging,
+            'blocked': None,
+            'waiting': None,
+            'problem': problem,
+            'affectedStalls': [],
+            'notes': '',
+        },
+    }
+
+
+class CommandCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.commands = []
+
+    def started(self, event):
+        self.commands.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def make_location(location_id, title=None, stalls=8, lat=47.4, lng=8.5, region='europe'):
+    return {
+        'location_id': location_id,
+        'title': title or location_id.title(),
+        'country': 'CH',
+        'region': region,
+        'chargers': '<p><strong>Charging</strong><br />%d Superchargers, available 24/7</p>' % stalls,
+        'latitude': str(lat),
+        'longitude': str(lng),
+    }
+
+
+class FakeTesla:
+    """Local stand-in for the all-locations endpoint of tesla.com."""
+    def __init__(self, locations):
+        self.locations = locations
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                locations = fake.locations
+                body = (locations if isinstance(locations, str) else json.dumps(locations)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/all-locations' % self.server.server_port
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@unittest.skipUnless(test_mongodb_uri, "TESLASUC_TEST_MONGODB_URI not set")
+class MongoTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = MongoClient(test_mongodb_uri).get_database()
+        for name in self.db.list_collection_names():
+            self.db.drop_collection(name)
+        migrations.migrate(self.db)
 
 
 class DateTest(unittest.TestCase):
@@ -17,6 +148,384 @@ class DateTest(unittest.TestCase):
         self.assertEquals(5, d.minute)
 
 
+class CsvTest(unittest.TestCase):
+    def test_convert(self):
+        items = [{'locationId': 'a', 'title': 'x, y', 'charging': None}, {'locationId': 'b', 'title': 'z', 'charging': 2}]
+        self.assertEqual('locationId,title,charging\na,"x, y",None\nb,z,2', convert_to_csv(items))
+
+    def test_stream_empty(self):
+        self.assertEqual([], list(iter_csv(iter([]))))
+
+
+class CursorTest(unittest.TestCase):
+    def test_round_trip(self):
+        t = datetime.datetime(2020, 3, 1, 12, 30, 5, 123000)
+        object_id = ObjectId()
+        self.assertEqual((t, object_id), parse_cursor(format_cursor(t, object_id)))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_cursor, '2020-03-01T12:30:05.123000Z_nope')
+        self.assertRaises(ValueError, parse_cursor, 'nope')
+
+
+class JsonArrayTest(unittest.TestCase):
+    def chunked(self, s, size):
+        return [s[i:i + size] for i in range(0, len(s), size)]
+
+    def test_chunks(self):
+        items = [{'location_id': 'a', 'title': 'x ] y', 'n': [1, 2]}, 12345, "s", None, {'nested': {'a': '}'}}]
+        s = json.dumps(items, indent=2)
+        for size in (1, 3, 7, len(s)):
+            self.assertEqual(items, list(parse_json_array(self.chunked(s, size))))
+
+    def test_empty(self):
+        self.assertEqual([], list(parse_json_array([' [ ', ' ]'])))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, list, parse_json_array(['<html>']))
+        self.assertRaises(ValueError, list, parse_json_array(['[{"a": 1}, {"b"']))
+
+
+class LruCacheTest(unittest.TestCase):
+    def test_eviction(self):
+        cache = LruCache(max_size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((1, 3), (cache.get('a'), cache.get('c')))
+        self.assertEqual({'size': 2, 'hits': 3, 'misses': 1}, cache.stats())
+
+    def test_ttl(self):
+        cache = LruCache(max_size=2, ttl=-1)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class VersionedCacheTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = VersionedCache('test')
+
+    def test_invalidated_during_compute(self):
+        computing, invalidated = threading.Event(), threading.Event()
+        results = []
+
+        def compute():
+            computing.set()
+            invalidated.wait(5)
+            return 'before import'
+
+        thread = threading.Thread(target=lambda: results.append(self.cache.get(self.db, 'key', compute)))
+        thread.start()
+        computing.wait(5)
+        self.cache.invalidate(self.db)
+        invalidated.set()
+        thread.join(5)
+
+        self.assertEqual(['before import'], results)
+        self.assertIsNone(self.cache.peek('key'))
+        self.assertEqual('after import', self.cache.get(self.db, 'key', lambda: 'after import'))
+        self.assertEqual('after import', self.cache.get(self.db, 'key', lambda: 'computed again'))
+
+    def test_invalidated_by_other_process(self):
+        self.assertEqual(1, self.cache.get(self.db, 'key', lambda: 1))
+        VersionedCache('test').invalidate(self.db)
+        self.cache.checked = None
+        self.assertEqual(2, self.cache.get(self.db, 'key', lambda: 2))
+
+    def test_max_entries(self):
+        cache = VersionedCache('test', max_entries=2)
+        version = cache.check(self.db)
+        for key in ('a', 'b', 'c'):
+            self.assertTrue(cache.put(version, key, key))
+        self.assertEqual({'c': 'c'}, cache.entries)
+        self.assertFalse(cache.put(version - 1, 'd', 'd'))
+
+
+class CommandMetricsTest(unittest.TestCase):
+    def event(self, command_name, command=None, request_id=1):
+        return type('Event', (), {'command_name': command_name, 'command': command or {}, 'connection_id': ('db', 27017),
+                                   'request_id': request_id, 'duration_micros': 1500})()
+
+    def sample(self, name, collection, command):
+        return metrics.REGISTRY.get_sample_value(name, {'collection': collection, 'command': command}) or 0
+
+    def test_per_collection(self):
+        listener = metrics.CommandMetrics()
+        before = self.sample('teslasuc_mongodb_command_duration_seconds_count', 'checkin', 'find')
+        listener.started(self.event('find', {'find': 'checkin', 'filter': {}}))
+        listener.started(self.event('getMore', {'getMore': 42, 'collection': 'checkin'}, request_id=2))
+        listener.succeeded(self.event('find'))
+        listener.failed(self.event('getMore', request_id=2))
+
+        self.assertEqual(before + 1, self.sample('teslasuc_mongodb_command_duration_seconds_count', 'checkin', 'find'))
+        self.assertEqual(1, self.sample('teslasuc_mongodb_command_failures_total', 'checkin', 'getMore'))
+        self.assertEqual({}, listener.collections)
+
+
+class WriteBehindTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def store(self, submissions):
+        self.release.wait()
+        self.batches.append(submissions)
+        return {i for i, s in enumerate(submissions) if s == 'bad'}
+
+    def test_batches(self):
+        writer = ingest.WriteBehind(self.store, batch_size=3, interval=60)
+        writer.put(['a'])
+        writer.put(['b', 'c'])
+        writer.put(['d'])
+        self.assertEqual({0}, writer.put(['bad', 'e'], wait=True))
+        writer.put(['f'])
+        writer.stop()
+        self.assertEqual([['a', 'b', 'c'], ['d', 'bad', 'e'], ['f']], self.batches)
+
+    def test_interval(self):
+        writer = ingest.WriteBehind(self.store, batch_size=100, interval=0.01)
+        self.assertEqual(set(), writer.put(['a'], wait=True))
+        self.assertEqual([['a']], self.batches)
+        writer.stop()
+
+    def test_backpressure(self):
+        self.release.clear()
+        writer = ingest.WriteBehind(self.store, batch_size=1, interval=60, max_queued=1)
+        writer.put(['a'])
+        writer.put(['b'])
+        with self.assertRaises(ingest.QueueFull):
+            writer.put(['c'])
+        self.release.set()
+        writer.stop()
+        self.assertEqual([['a'], ['b']], self.batches)
+
+    def test_timeouts(self):
+        self.release.clear()
+        writer = ingest.WriteBehind(self.store, batch_size=1, interval=60, max_queued=1)
+        with self.assertRaises(ingest.FlushTimeout):
+            writer.put(['a'], wait=True, timeout=0.05)
+        writer.put(['b'])
+        with self.assertLogs(ingest.logger, 'WARNING'):
+            writer.stop(timeout=0.05)
+        self.release.set()
+        writer.stop()
+        self.assertEqual([['a'], ['b']], self.batches)
+
+
+class StrftimeEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        elif isinstance(o, datetime.datetime):
+            return o.strftime(TimeFormat)
+        return json.JSONEncoder.default(self, o)
+
+
+class SerializeTest(unittest.TestCase):
+    def test_format_time(self):
+        for t in [datetime.datetime(2020, 3, 8, 12, 15), datetime.datetime(2020, 3, 8, 12, 15, 3, 120),
+                  datetime.datetime(999, 1, 1), timezone('Europe/Zurich').localize(datetime.datetime(2020, 3, 8, 12, 15))]:
+            self.assertEqual(t.strftime(TimeFormat), serialize.format_time(t))
+
+    def test_same_as_jsonify(self):
+        app = Flask('test')
+        app.json_encoder = StrftimeEncoder
+        data = {'items': [{'time': datetime.datetime(2020, 3, 8, 12, 15, 3, 120), '_id': ObjectId(), 'title': 'Zürich',
+                           'utilization': 1 / 3, 'big': 1e16, 'small': 1e-5, 'none': None, 'notes': '<b>"x"</b>\n'}],
+                'country': 'CH'}
+        with app.app_context():
+            self.assertEqual(jsonify(data).get_data(), serialize.response(data).get_data())
+
+
+class StartupTest(unittest.TestCase):
+    def test_no_database_traffic(self):
+        # nothing listens on this port, importing api must not try to connect
+        result = benchmark.measure_startup('mongodb://127.0.0.1:9/teslasuc_test')
+        self.assertEqual(0, result['commands'])
+        self.assertLess(result['seconds'], 10)
+
+
+class EventsTest(unittest.TestCase):
+    def setUp(self):
+        self.hub = events._hub = events.Hub()
+        events._hub_pid = os.getpid()
+        self.seq = 0
+
+    def tearDown(self):
+        events._hub = None
+
+    def event(self, location_id, country='CH'):
+        self.seq += 1
+        return {'_id': ObjectId(), 'seq': self.seq, 'type': 'checkin', 'locationId': location_id, 'country': country}
+
+    def test_resume(self):
+        first, second = self.event('zurich'), self.event('bern')
+        self.hub.dispatch(first)
+        self.hub.dispatch(second)
+        q, backlog = self.hub.subscribe(first['seq'])
+        self.assertEqual([second], backlog)
+        self.assertIsNone(self.hub.subscribe(42)[1])
+
+        third = self.event('munich', country='DE')
+        self.hub.dispatch(third)
+        self.assertEqual(third, q.get_nowait())
+
+    def test_slow_subscriber(self):
+        q, backlog = self.hub.subscribe()
+        for i in range(events.max_pending + 1):
+            self.hub.dispatch(self.event('zurich'))
+        self.assertTrue(q.overflowed)
+        self.assertEqual(set(), self.hub.subscribers)
+
+    def test_stream(self):
+        first = self.event('zurich')
+        self.hub.dispatch(first)
+        stream = events.stream(None, serialize.dumps, country='CH', after=first['seq'])
+        self.hub.dispatch(self.event('munich', country='DE'))
+        zurich = self.event('zurich')
+        threading.Timer(0.05, self.hub.dispatch, [zurich]).start()
+        self.assertEqual('id: %d\ndata: {"country":"CH","locationId":"zurich","type":"checkin"}\n\n' % zurich['seq'],
+                         next(stream))
+        stream.close()
+        self.assertEqual(set(), self.hub.subscribers)
+
+    def test_too_many_streams(self):
+        hub = events.Hub(max_subscribers=1)
+        q, backlog = hub.subscribe()
+        with self.assertRaises(events.TooManyStreams):
+            hub.subscribe()
+        hub.unsubscribe(q)
+        hub.subscribe()
+
+    def test_parse_id(self):
+        self.assertEqual(12, events.parse_id('12'))
+        self.assertIsNone(events.parse_id(str(ObjectId())))
+        for s in ('', '-1', '1.5', 'x'):
+            with self.assertRaises(ValueError):
+                events.parse_id(s)
+
+
+class EventStreamTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        # api connects when it is imported
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        self.client = api.app.test_client()
+        events._hub = events.Hub(max_subscribers=0)
+        events._hub_pid = os.getpid()
+
+    def tearDown(self):
+        events._hub = None
+        super().tearDown()
+
+    def test_too_many_streams(self):
+        response = self.client.get('/events')
+        self.assertEqual(503, response.status_code)
+        self.assertEqual(str(events.retry_after), response.headers['Retry-After'])
+        self.assertEqual('retry: %d\n\n' % (events.retry_after * 1000), response.get_data(as_text=True))
+
+    def test_resume(self):
+        events.publish(self.db, [{'type': 'checkin', 'locationId': 'zurich', 'country': 'CH'}])
+        # written by another worker, its ObjectId sorts before the event above
+        events.publish(self.db, [{'_id': ObjectId.from_datetime(datetime.datetime(2020, 1, 1)), 'type': 'checkin',
+                                  'locationId': 'bern', 'country': 'CH'},
+                                 {'type': 'checkin', 'locationId': 'munich', 'country': 'DE'}])
+        self.assertEqual([1, 2, 3], [e['seq'] for e in self.db.event.find().sort('$natural', 1)])
+
+        # nothing buffered, the backlog is read from the database
+        events._hub = events.Hub()
+        stream = events.stream(self.db, serialize.dumps, country='CH', after=1)
+        self.assertEqual('id: 2\ndata: {"country":"CH","locationId":"bern","type":"checkin"}\n\n', next(stream))
+        stream.close()
+
+    def test_concurrent_publishers(self):
+        def other():
+            events.publish(self.db, [{'type': 'checkin', 'locationId': 'bern', 'country': 'CH'},
+                                     {'type': 'checkin', 'locationId': 'basel', 'country': 'CH'}])
+
+        db = RacingDb(self.db, None)
+        db.event = RacingInserts(self.db.event, other)
+        events.publish(db, [{'type': 'checkin', 'locationId': 'zurich', 'country': 'CH'}])
+
+        # stored in the order of their numbers, whoever took a number first
+        self.assertEqual([('bern', 1), ('basel', 2), ('zurich', 3)],
+                         [(e['locationId'], e['seq']) for e in self.db.event.find().sort('$natural', 1)])
+        events._hub = events.Hub()
+        stream = events.stream(self.db, serialize.dumps, after=1)
+        self.assertEqual(['id: 2', 'id: 3'], [next(stream).split('\n')[0] for i in range(2)])
+        stream.close()
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * earth_radius * math.asin(math.sqrt(a))
+
+
+class KdTreeTest(unittest.TestCase):
+    def setUp(self):
+        r = random.Random(42)
+        self.points = [(r.uniform(35, 70), r.uniform(-10, 30), i) for i in range(2000)]
+        self.points += [(89.9, 0.0, 'north'), (0.0, 179.99, 'east'), (0.0, -179.99, 'west')]
+        self.tree = KdTree(self.points)
+
+    def brute_force(self, lat, lng):
+        return sorted((haversine(lat, lng, p[0], p[1]), p[2]) for p in self.points)
+
+    def test_within(self):
+        for lat, lng, radius in [(47.4, 8.5, 50000), (60, 20, 200000), (0, 180, 10000), (-50, 0, 1000)]:
+            expected = [v for d, v in self.brute_force(lat, lng) if d <= radius]
+            found = self.tree.within(lat, lng, radius)
+            self.assertEqual(expected, [v for d, v in found])
+            self.assertEqual(sorted(d for d, v in found), [d for d, v in found])
+
+    def test_nearest(self):
+        for lat, lng, k in [(47.4, 8.5, 10), (89, 100, 3), (10, -170, 5), (50, 10, 0)]:
+            expected = self.brute_force(lat, lng)[:k]
+            found = self.tree.nearest(lat, lng, k)
+            self.assertEqual([v for d, v in expected], [v for d, v in found])
+            for (d1, v1), (d2, v2) in zip(expected, found):
+                self.assertAlmostEqual(d1, d2, delta=1)
+
+    def test_nearest_within_radius(self):
+        expected = [v for d, v in self.brute_force(47.4, 8.5) if d <= 30000][:50]
+        self.assertEqual(expected, [v for d, v in self.tree.nearest(47.4, 8.5, 50, 30000)])
+
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SearchIndex([
+            (('Zürich West', 'zurichwest', None), 'zurichwest'),
+            (('Zürich', 'zurich', 'Zurich Hardturm'), 'zurich'),
+            (('Dietlikon', 'dietlikon', 'Zürich Nord'), 'dietlikon'),
+            (('Neuberg, Germany', 'neuberg', None), 'neuberg'),
+            (('Bad Zurzach', 'zurzach', None), 'zurzach'),
+        ])
+
+    def test_fold(self):
+        self.assertEqual('zurich', fold('ZÜRICH'))
+
+    def test_ranking(self):
+        self.assertEqual(['zurich', 'zurichwest', 'dietlikon'], self.index.search('zurich'))
+        self.assertEqual(['zurich', 'zurichwest', 'dietlikon', 'zurzach'], self.index.search('zür'))
+        self.assertEqual(['zurich'], self.index.search('zurich', limit=1))
+
+    def test_substring(self):
+        self.assertEqual(['neuberg'], self.index.search('rg, ger'))
+        self.assertEqual(['dietlikon'], self.index.search('h nord'))
+        self.assertEqual([], self.index.search('basel'))
+
+    def test_short(self):
+        self.assertEqual(['zurich', 'zurichwest', 'dietlikon', 'zurzach'], self.index.search('z'))
+        self.assertEqual(['zurichwest', 'zurich', 'dietlikon', 'zurzach'], self.index.matches('zu'))
+        self.assertEqual(['neuberg'], self.index.matches('eu'))
+
+
 class ParseTest(unittest.TestCase):
     def setUp(self):
         pass
@@ -40,3 +549,706 @@ class ParseTest(unittest.TestCase):
     def test_dec_10(self):
         s = "<p><strong>Charging</strong><br />10 Tesla Connector, up to 22kW.<br />Available for patrons only. Self park.</p>"
         self.assertEquals(10, chargers(s))
+
+
+class OverviewTest(MongoTestCase):
+    def insert(self, submission):
+        self.db.checkin.insert_one(submission)
+        overview.add_checkin(self.db, submission)
+
+    def test_incremental_matches_rebuild(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        overview.rebuild(self.db)
+        self.insert(make_submission('zurich', now - timedelta(hours=3), charging=2, problem='limitedPower'))
+        self.insert(make_submission('zurich', now - timedelta(hours=1), charging=6))
+        self.insert(make_submission('zurich', now - timedelta(hours=2), charging=None, problem='partialFailure'))
+        self.insert(make_submission('bern', now - timedelta(days=20), charging=1))
+        self.insert(make_submission('bern', now - timedelta(days=1), charging=4))
+
+        incremental = overview.read(self.db)
+        overview.rebuild(self.db)
+        self.assertEqual(overview.read(self.db), incremental)
+
+        zurich = [r for r in incremental if r['locationId'] == 'zurich'][0]
+        self.assertEqual(3, zurich['checkins'])
+        self.assertAlmostEqual(0.5, zurich['utilization'])
+        self.assertEqual('none', zurich['problem'])
+        self.assertEqual(1, [r for r in incremental if r['locationId'] == 'bern'][0]['checkins'])
+
+    def test_expire(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        self.db.checkin.insert_one(make_submission('zurich', now - timedelta(days=15), charging=8))
+        self.db.checkin.insert_one(make_submission('zurich', now - timedelta(days=2), charging=0))
+        self.db.checkin.insert_one(make_submission('bern', now - timedelta(days=15)))
+
+        overview.recompute(self.db, now - timedelta(days=16))
+        self.db.meta.replace_one({'_id': 'overview'}, {'_id': 'overview', 'windowStart': now - timedelta(days=16)},
+                                 upsert=True)
+        overview.expire(self.db)
+
+        # kept empty, so delta syncs can report it as removed
+        self.assertEqual(0, self.db.overview.find_one({'_id': 'bern'})['checkins'])
+        self.assertNotIn('bern', [r['locationId'] for r in overview.read(self.db)])
+        zurich = self.db.overview.find_one({'_id': 'zurich'})
+        self.assertEqual(1, zurich['checkins'])
+        self.assertEqual(0, zurich['utilizationSum'])
+
+    def test_changes(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        self.insert(make_submission('zurich', now - timedelta(days=3), charging=1))
+        self.insert(make_submission('bern', now - timedelta(days=2), charging=1))
+        self.insert(make_submission('basel', now - timedelta(days=2), charging=1))
+        self.db.overview.update_many({}, {'$set': {'updated': now - timedelta(days=1)}})
+        self.db.overview.update_one({'_id': 'basel'}, {'$set': {'lastCheckin': now - overview.window - timedelta(minutes=10)}})
+        self.db.meta.replace_one({'_id': 'overview'}, {'_id': 'overview', 'windowStart': now - overview.window}, upsert=True)
+        since = now - timedelta(hours=1)
+
+        changed, removed = overview.changes(self.db, since)
+        self.assertEqual([], changed)
+        self.assertEqual(['basel'], removed)
+
+        self.insert(make_submission('bern', now - timedelta(minutes=5), charging=3))
+        changed, removed = overview.changes(self.db, since)
+        self.assertEqual(['bern'], [r['locationId'] for r in changed])
+        self.assertEqual(2, changed[0]['checkins'])
+        self.assertEqual([r for r in overview.read(self.db) if r['locationId'] == 'bern'], changed)
+        self.assertEqual(['basel'], removed)
+        self.assertEqual(([], []), overview.changes(self.db, now + timedelta(minutes=1)))
+
+    def test_built_by_migration(self):
+        self.assertIsNotNone(self.db.meta.find_one({'_id': 'overview'}))
+        self.db.meta.delete_one({'_id': 'overview'})
+        self.db.checkin.insert_one(make_submission('zurich', tz_utc.localize(datetime.datetime.utcnow()), charging=1))
+        overview._last_sweep = None
+
+        # requests do not rebuild, not even when the migration did not run
+        self.assertEqual([], overview.read(self.db))
+        self.assertIsNone(self.db.meta.find_one({'_id': 'overview'}))
+
+    def test_single_rebuild(self):
+        self.assertTrue(jobs.acquire(self.db, 'rebuild:overview', ObjectId()))
+        self.assertIsNone(overview.rebuild(self.db))
+
+
+class RacingCheckins:
+    """Checkin collection whose aggregations let another writer in before they return."""
+    def __init__(self, collection, race):
+        self.collection = collection
+        self.race = race
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def aggregate(self, pipeline):
+        results = list(self.collection.aggregate(pipeline))
+        race, self.race = self.race, None
+        if race:
+            race()
+        return results
+
+
+class RacingInserts:
+    """Collection whose first insert lets another writer in before it is written."""
+    def __init__(self, collection, race):
+        self.collection = collection
+        self.race = race
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def insert_many(self, documents):
+        race, self.race = self.race, None
+        if race:
+            race()
+        return self.collection.insert_many(documents)
+
+
+class RacingDb:
+    def __init__(self, db, race):
+        self.db = db
+        self.checkin = RacingCheckins(db.checkin, race)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+
+class OverviewRaceTest(MongoTestCase):
+    def insert(self, submission):
+        self.db.checkin.insert_one(submission)
+        overview.add_checkin(self.db, submission)
+
+    def test_recompute_keeps_concurrent_checkins(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        self.insert(make_submission('zurich', now - timedelta(days=20), charging=1))
+        self.insert(make_submission('zurich', now - timedelta(days=2), charging=1))
+        self.insert(make_submission('bern', now - timedelta(days=20), charging=1))
+
+        db = RacingDb(self.db, lambda: [self.insert(make_submission(location_id, now, charging=4))
+                                        for location_id in ('zurich', 'bern')])
+        overview.recompute(db, now - overview.window, ['zurich', 'bern'])
+
+        self.assertEqual({'zurich': 2, 'bern': 1}, {o['_id']: o['checkins'] for o in self.db.overview.find()})
+
+
+class LastCheckinsTest(MongoTestCase):
+    def test_round_trips(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        for i in range(40):
+            self.db.checkin.insert_one(make_submission('suc%d' % i, now - timedelta(hours=2), charging=1))
+            self.db.checkin.insert_one(make_submission('suc%d' % i, now - timedelta(hours=1), charging=2))
+
+        counter = CommandCounter()
+        db = MongoClient(test_mongodb_uri, event_listeners=[counter]).get_database()
+
+        few = overview.last_checkins(db, ['suc%d' % i for i in range(2)])
+        round_trips_few = len(counter.commands)
+        many = overview.last_checkins(db, ['suc%d' % i for i in range(40)])
+
+        self.assertEqual(2, len(few))
+        self.assertEqual(40, len(many))
+        self.assertEqual(2, many['suc7']['charging'])
+        self.assertEqual(round_trips_few, len(counter.commands) - round_trips_few)
+
+
+class ImportCheckinsTest(MongoTestCase):
+    def test_import(self):
+        self.db.suc.insert_many([
+            {'type': 'supercharger', 'locationId': 'neuberg', 'title': 'Neuberg', 'country': 'DE', 'raw': {'region': 'europe'}},
+            {'type': 'supercharger', 'locationId': 'neubergsued', 'title': 'Neuberg Sued', 'country': 'DE', 'raw': {'region': 'europe'}},
+            {'type': 'supercharger', 'locationId': 'schweitenkirchen', 'title': 'Schweitenkirchen', 'country': 'DE',
+             'raw': {'region': 'europe', 'common_name': 'Schweiti'}},
+        ])
+        result = import_checkins("06/23/2013,13:15,schweiti,6,3,0,0\n"
+                                 "07/09/2014,18:20,Neuberg,8,2,0,0\n"
+                                 "07/09/2014,18:20,Schweitenkirchen,x,2,0,0\n", self.db.suc, self.db.checkin, batch_size=1)
+
+        self.assertEqual(3, result['rows'])
+        self.assertEqual(2, result['imported'])
+        self.assertEqual([2, 3], [e['line'] for e in result['errors']])
+        self.assertEqual('schweitenkirchen', self.db.checkin.find_one({'error': None})['suc']['locationId'])
+
+    def test_overview(self):
+        self.db.suc.insert_one({'type': 'supercharger', 'locationId': 'neuberg', 'title': 'Neuberg', 'country': 'DE',
+                                'loc': {'type': 'Point', 'coordinates': [8.9, 50.2]}, 'raw': {'region': 'europe'}})
+        day = (datetime.datetime.utcnow() - timedelta(days=1)).strftime('%m/%d/%Y')
+        import_checkins("%s,10:00,Neuberg,8,2,0,0\n%s,11:00,Neuberg,8,4,0,0\n%s,12:00,Nowhere,8,4,0,0\n"
+                        % (day, day, day), self.db.suc, self.db.checkin)
+
+        incremental = overview.read(self.db)
+        self.assertEqual([('neuberg', 2, 0.375)], [(r['locationId'], r['checkins'], r['utilization']) for r in incremental])
+        overview.rebuild(self.db)
+        self.assertEqual(incremental, overview.read(self.db))
+
+
+class ImportFromUrlTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tesla = FakeTesla([make_location('zurich'), make_location('bern'), make_location('basel')])
+        self.addCleanup(self.tesla.close)
+
+    def test_diff(self):
+        result = import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.assertEqual((3, 0, 0, 0), (result['inserted'], result['updated'], result['unchanged'], result['removed']))
+
+        self.tesla.locations = [make_location('zurich', stalls=12), make_location('bern'), make_location('geneva')]
+        result = import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.assertEqual((1, 1, 1, 1), (result['inserted'], result['updated'], result['unchanged'], result['removed']))
+        self.assertEqual(12, self.db.suc.find_one({'locationId': 'zurich'})['stalls'])
+        self.assertIsNone(self.db.suc.find_one({'locationId': 'basel'}))
+
+    def test_batches(self):
+        result = import_from_url(self.tesla.url, 'supercharger', self.db.suc, True, batch_size=1)
+        self.assertEqual(3, result['inserted'])
+        self.assertEqual({'download', 'parse', 'normalize', 'write'}, set(result['timings'].keys()))
+
+    def test_incomplete_list(self):
+        import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.tesla.locations = '[%s, {"location_id": ' % json.dumps(make_location('geneva'))
+        result = import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.assertIn('error', result)
+        self.assertEqual((1, 0), (result['inserted'], result['removed']))
+        self.assertEqual(4, self.db.suc.count_documents({}))
+
+    def test_invalid_location(self):
+        import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.tesla.locations = [make_location('zurich', stalls=12), dict(make_location('bern'), latitude=''),
+                                make_location('geneva')]
+        result = import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.assertNotIn('error', result)
+        self.assertEqual((1, 1, 1, 1), (result['inserted'], result['updated'], result['failed'], result['removed']))
+        self.assertEqual(['bern', 'geneva', 'zurich'], sorted(self.db.suc.distinct('locationId')))
+
+    def test_keep_other_types(self):
+        import_from_url(self.tesla.url, 'destination_charger', self.db.suc, False)
+        self.tesla.locations = [make_location('zurich')]
+        import_from_url(self.tesla.url, 'supercharger', self.db.suc, True)
+        self.assertEqual(3, self.db.suc.count_documents({'type': 'destination_charger'}))
+
+
+class JobsTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tesla = FakeTesla([make_location('zurich'), make_location('bern')])
+        self.addCleanup(self.tesla.close)
+
+    def wait(self, job_id):
+        for i in range(100):
+            job = jobs.status(self.db, str(job_id))
+            if job['status'] in ('done', 'failed'):
+                return job
+            threading.Event().wait(0.05)
+        self.fail("job did not finish")
+
+    def test_import_job(self):
+        job_id = jobs.submit(self.db, 'import:supercharger',
+                             lambda progress: import_from_url(self.tesla.url, 'supercharger', self.db.suc, True, progress))
+        job = self.wait(job_id)
+        self.assertEqual('done', job['status'])
+        self.assertEqual(2, job['result']['inserted'])
+        self.assertEqual('write', job['progress']['stage'])
+        self.assertIsNone(self.db.lock.find_one({'_id': 'import:supercharger'}))
+
+    def test_single_job_per_name(self):
+        running = threading.Event()
+        release = threading.Event()
+
+        def target(progress):
+            running.set()
+            release.wait(5)
+            return {}
+
+        job_id = jobs.submit(self.db, 'import:supercharger', target)
+        running.wait(5)
+        self.assertIsNone(jobs.submit(self.db, 'import:supercharger', target))
+        self.assertIsNotNone(jobs.submit(self.db, 'import:destination_charger', lambda progress: {}))
+        release.set()
+        self.assertEqual('done', self.wait(job_id)['status'])
+
+    def test_failed_job(self):
+        def target(progress):
+            raise ValueError("boom")
+
+        job = self.wait(jobs.submit(self.db, 'import:supercharger', target))
+        self.assertEqual('failed', job['status'])
+        self.assertEqual('boom', job['error'])
+
+
+class RollupsTest(MongoTestCase):
+    def test_incremental_matches_rebuild(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        self.db.suc.insert_many([{'type': 'supercharger', 'locationId': l, 'country': c} for l, c in
+                                 [('zurich', 'CH'), ('bern', 'CH'), ('munich', 'DE')]])
+        rollups.rebuild(self.db)
+
+        submissions = [make_submission('zurich', now, charging=2), make_submission('zurich', now, charging=None),
+                       make_submission('bern', now, charging=8), make_submission('munich', now, charging=4)]
+        submissions[3]['suc']['country'] = 'DE'
+        self.db.checkin.insert_many(submissions)
+        rollups.add_checkins(self.db, submissions[:1])
+        rollups.add_checkins(self.db, submissions[1:])
+
+        incremental = (rollups.countries(self.db), rollups.locations(self.db, 'CH'))
+        rollups.rebuild(self.db)
+        self.assertEqual((rollups.countries(self.db), rollups.locations(self.db, 'CH')), incremental)
+
+        self.assertEqual([{'country': 'CH', 'sucs': 2, 'checkins': 3, 'utilization': 0.625},
+                          {'country': 'DE', 'sucs': 1, 'checkins': 1, 'utilization': 0.5}], incremental[0])
+        self.assertEqual({'checkins': 2, 'utilization': 0.25}, incremental[1]['zurich'])
+
+    def test_rebuild_keeps_concurrent_checkins(self):
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        self.db.suc.insert_one({'type': 'supercharger', 'locationId': 'zurich', 'country': 'CH'})
+        self.db.checkin.insert_one(make_submission('zurich', now, charging=2))
+
+        def store():
+            submission = make_submission('zurich', now, charging=4)
+            self.db.checkin.insert_one(submission)
+            rollups.add_checkins(self.db, [submission])
+
+        self.assertIsNotNone(rollups.rebuild(RacingDb(self.db, store)))
+        self.assertEqual({'checkins': 2, 'utilization': 0.375}, rollups.locations(self.db, 'CH')['zurich'])
+        self.assertEqual([{'country': 'CH', 'sucs': 1, 'checkins': 2, 'utilization': 0.375}], rollups.countries(self.db))
+        self.assertIn('kind_1_country_1', self.db.rollup.index_information())
+
+    def test_single_rebuild(self):
+        self.assertTrue(jobs.acquire(self.db, 'rebuild:rollups', ObjectId()))
+        self.assertIsNone(rollups.rebuild(self.db))
+
+
+class HistoryTest(MongoTestCase):
+    def test_floor(self):
+        self.assertEqual(datetime.datetime(2020, 3, 2), history.floor(datetime.datetime(2020, 3, 8, 23, 59), timedelta(weeks=1)))
+        self.assertEqual(datetime.datetime(2020, 3, 8, 23), history.floor(datetime.datetime(2020, 3, 8, 23, 59), timedelta(hours=1)))
+
+    def test_buckets(self):
+        day = history.floor(datetime.datetime.utcnow(), timedelta(days=1))
+        old = day - timedelta(days=60)
+        submissions = [make_submission('zurich', old + timedelta(hours=1), charging=2),
+                       make_submission('zurich', old + timedelta(hours=5), charging=6, problem='limitedPower'),
+                       make_submission('zurich', old + timedelta(days=1), charging=None),
+                       make_submission('zurich', day + timedelta(minutes=1), charging=1),
+                       make_submission('bern', old, charging=3)]
+        self.db.checkin.insert_many(submissions)
+
+        items = history.buckets(self.db, 'zurich', 'day')
+        self.assertEqual([old, old + timedelta(days=1), day], [i['time'] for i in items])
+        self.assertEqual((2, 4, 6, 0.5), (items[0]['count'], items[0]['charging'], items[0]['chargingMax'], items[0]['problemShare']))
+        self.assertIsNone(items[1]['charging'])
+
+        self.assertEqual([old + timedelta(days=1)], [i['time'] for i in history.buckets(
+            self.db, 'zurich', 'day', old + timedelta(days=1, hours=12), day)])
+
+        # final buckets are served from the cache until checkins are imported
+        self.db.checkin.insert_one(make_submission('zurich', old + timedelta(days=2), charging=1))
+        self.assertEqual(3, len(history.buckets(self.db, 'zurich', 'day')))
+        history.invalidate(self.db)
+        self.assertEqual(4, len(history.buckets(self.db, 'zurich', 'day')))
+
+    def test_concurrent_extension(self):
+        old = history.floor(datetime.datetime.utcnow(), timedelta(days=1)) - timedelta(days=60)
+        self.db.checkin.insert_many([make_submission('zurich', old, charging=2),
+                                     make_submission('zurich', old + timedelta(days=1), charging=2)])
+        history.invalidate(self.db)
+
+        # both requests aggregate before either stores the extended entry
+        both = threading.Barrier(2, timeout=5)
+        aggregate = history.aggregate
+
+        def aggregate_together(*args):
+            both.wait()
+            return aggregate(*args)
+
+        with mock.patch.object(history, 'aggregate', aggregate_together):
+            threads = [threading.Thread(target=history.buckets, args=(self.db, 'zurich', 'day')) for i in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(2, len(history.buckets(self.db, 'zurich', 'day')))
+
+
+class CatalogLocationTest(MongoTestCase):
+    def test_cached_until_import(self):
+        catalog.invalidate(self.db)
+        self.db.suc.insert_one(location_document(make_location('zurich', title='Zürich'), 'supercharger'))
+        before = catalog.location_stats()
+
+        self.assertEqual('Zürich', catalog.location(self.db, 'zurich')['title'])
+        self.db.suc.update_one({'locationId': 'zurich'}, {'$set': {'title': 'Zürich Nord'}})
+        self.assertEqual('Zürich', catalog.location(self.db, 'zurich')['title'])
+        self.assertIsNone(catalog.location(self.db, 'bern'))
+        after = catalog.location_stats()
+        self.assertEqual((1, 2), (after['hits'] - before['hits'], after['misses'] - before['misses']))
+        self.assertEqual(before['hits'] + 1, REGISTRY.get_sample_value('teslasuc_location_cache_lookups_total', {'result': 'hit'}))
+        self.assertEqual(before['misses'] + 2, REGISTRY.get_sample_value('teslasuc_location_cache_lookups_total', {'result': 'miss'}))
+
+        catalog.invalidate(self.db)
+        self.assertEqual('Zürich Nord', catalog.location(self.db, 'zurich')['title'])
+
+
+class DataVersionTest(MongoTestCase):
+    def test_bump(self):
+        data_version.bump(self.db)
+        before = data_version.etag(self.db)
+        self.assertEqual(before, data_version.etag(self.db))
+        self.assertTrue(data_version.etag(self.db, timedelta(minutes=1)).startswith(before + '-'))
+
+        self.db.suc.insert_one(location_document(make_location('zurich'), 'supercharger'))
+        import_checkins("03/08/2020,12:15,Zurich,8,2,0,0\n", self.db.suc, self.db.checkin)
+        self.assertNotEqual(before, data_version.etag(self.db))
+
+    def test_changed(self):
+        with mock.patch.object(data_version, 'bump_interval', 0.2), \
+                mock.patch.object(data_version, 'bump', wraps=data_version.bump) as bump:
+            data_version._last_bump = None
+            for i in range(5):
+                data_version.changed(self.db)
+            self.assertEqual(1, bump.call_count)
+            before = data_version.etag(self.db)
+
+            data_version._timer.join(1)
+            self.assertEqual(2, bump.call_count)
+            self.assertNotEqual(before, data_version.etag(self.db))
+
+
+class LookupTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        self.client = api.app.test_client()
+        api.encoded_responses.clear()
+        catalog.invalidate(self.db)
+        self.db.suc.insert_one(location_document(make_location('zurich'), 'supercharger'))
+        self.db.suc.insert_one(location_document(make_location('bern', lat=46.95, lng=7.45), 'supercharger'))
+
+    def test_distance(self):
+        for url in ('/lookup?query=47.4,8.5&k=5', '/lookup?query=47.4,8.5&radius=100000'):
+            results = self.client.get(url).get_json()
+            self.assertEqual(['zurich', 'bern'], [r['locationId'] for r in results], url)
+            self.assertEqual(0, results[0]['distance'], url)
+            self.assertAlmostEqual(haversine(47.4, 8.5, 46.95, 7.45), results[1]['distance'], delta=1)
+        self.assertNotIn('distance', self.client.get('/lookup?query=zur').get_json()[0])
+
+
+class ConditionalTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        self.client = api.app.test_client()
+        api.encoded_responses.clear()
+        catalog.invalidate(self.db)
+        data_version.bump(self.db)
+        # the checkins of other tests must not defer the bump of this one
+        data_version._last_bump = data_version._timer = None
+        self.db.suc.insert_one(location_document(make_location('zurich'), 'supercharger'))
+        self.db.checkin.insert_one(make_submission('zurich', tz_utc.localize(datetime.datetime.utcnow()), charging=2))
+        overview.rebuild(self.db)
+        rollups.rebuild(self.db)
+
+    def test_not_modified(self):
+        for url, expected in (('/overview?callback=cb', 'zurich'), ('/stats', '"CH"'), ('/lookup?query=zur', 'zurich')):
+            response = self.client.get(url)
+            self.assertEqual(200, response.status_code, url)
+            self.assertIn(expected, response.get_data(as_text=True), url)
+            self.assertEqual('public, max-age=%d' % data_version.max_age, response.headers['Cache-Control'], url)
+            etag = response.headers['ETag']
+
+            cached = self.client.get(url)
+            self.assertEqual((200, etag), (cached.status_code, cached.headers['ETag']), url)
+            self.assertEqual(response.data, cached.data, url)
+
+            not_modified = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual((304, b'', etag), (not_modified.status_code, not_modified.data, not_modified.headers['ETag']), url)
+        self.assertTrue(self.client.get('/overview?callback=cb').data.startswith(b'cb(['))
+
+    def test_invalidated_by_checkin(self):
+        response = self.client.get('/stats')
+        etag = response.headers['ETag']
+        self.assertEqual(1, response.get_json()[0]['checkins'])
+
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        self.assertEqual(200, self.client.post('/checkin', data=json.dumps({
+            'time': now, 'locationId': 'zurich', 'stalls': 8, 'charging': 4, 'problem': 'none', 'affectedStalls': [],
+            'tffUserId': 'tester', 'notes': ''})).status_code)
+
+        response = self.client.get('/stats', headers={'If-None-Match': etag})
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response.headers['ETag'])
+        self.assertEqual(2, response.get_json()[0]['checkins'])
+        self.assertEqual(2, [r for r in self.client.get('/overview').get_json() if r['locationId'] == 'zurich'][0]['checkins'])
+
+
+class CheckinBatchTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        # api connects when it is imported
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        self.client = api.app.test_client()
+        catalog.invalidate(self.db)
+        self.db.suc.insert_one(location_document(make_location('zurich'), 'supercharger'))
+
+    def test_partial_failure(self):
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        checkin = {'time': now, 'locationId': 'zurich', 'stalls': 8, 'charging': 2, 'problem': 'none',
+                   'affectedStalls': [], 'tffUserId': 'tester', 'notes': ''}
+        response = self.client.post('/checkinBatch', data=json.dumps([
+            checkin, dict(checkin, locationId='nowhere'), dict(checkin, charging=9), 'checkin', dict(checkin, charging=4)]))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'imported': 2, 'items': [{'error': None}, {'error': 'Invalid location'},
+                                                   {'error': 'Charging/blocked cannot be larger than stalls'},
+                                                   {'error': 'Invalid data received'}, {'error': None}]},
+                         response.get_json())
+        self.assertEqual([2, 4], sorted(c['checkin']['charging'] for c in self.db.checkin.find()))
+        self.assertEqual(2, self.db.overview.find_one({'_id': 'zurich'})['checkins'])
+
+    def test_invalid(self):
+        self.assertEqual(400, self.client.post('/checkinBatch', data=json.dumps({'time': 'x'})).status_code)
+
+    def test_invalid_types(self):
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        checkin = {'time': now, 'locationId': 'zurich', 'stalls': 8, 'charging': 2, 'problem': 'none',
+                   'affectedStalls': [], 'tffUserId': 'tester', 'notes': ''}
+        response = self.client.post('/checkinBatch', data=json.dumps([
+            dict(checkin, stalls=None), dict(checkin, stalls=True), dict(checkin, charging=[1]), dict(checkin, time=5),
+            dict(checkin, locationId=['x']), dict(checkin, problem=None), checkin]))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({'imported': 1, 'items': [{'error': 'Invalid number'}, {'error': 'Invalid number'},
+                                                   {'error': 'Invalid number'}, {'error': 'Invalid date'},
+                                                   {'error': 'Invalid location'}, {'error': 'Value is not a string'},
+                                                   {'error': None}]},
+                         response.get_json())
+
+    def test_invalid_location(self):
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        checkin = {'time': now, 'stalls': 8, 'charging': 2, 'problem': 'none', 'affectedStalls': [],
+                   'tffUserId': 'tester', 'notes': ''}
+        for location_id in (['zurich'], {'$ne': None}, 5):
+            response = self.client.post('/checkin', data=json.dumps(dict(checkin, locationId=location_id)))
+            self.assertEqual((400, 'Invalid location'), (response.status_code, response.get_json()['message']))
+
+
+class MigrationsTest(MongoTestCase):
+    def test_migrate(self):
+        self.assertEqual(len(migrations.migrations), migrations.version(self.db))
+        self.assertIn('checkin.time_-1__id_-1', self.db.checkin.index_information())
+        self.assertEqual(len(migrations.migrations), migrations.migrate(self.db))
+
+
+class SnapshotTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        snapshot._decoded.clear()
+        self.db.suc.insert_one(location_document(make_location('zurich'), 'supercharger'))
+        self.db.suc.insert_one(location_document(make_location('bern', stalls=6), 'supercharger'))
+        self.db.suc.insert_one(location_document(dict(make_location('hotel'), country='DE'), 'destination_charger'))
+
+    def test_versions(self):
+        self.assertEqual(1, snapshot.generate(self.db))
+        self.assertEqual(1, snapshot.generate(self.db))
+
+        packed = json.loads(gzip.decompress(snapshot.load(self.db, 1)['data']).decode('utf-8'))
+        self.assertEqual(['destination_charger', 'supercharger'], packed['types'])
+        self.assertEqual(['hotel', 'bern', 'zurich'], packed['columns']['locationId'])
+        self.assertEqual([8, 6, 8], packed['columns']['stalls'])
+        self.assertEqual({'locationId': 'bern', 'title': 'Bern', 'country': 'CH', 'stalls': 6, 'lat': 47.4, 'lng': 8.5,
+                          'type': 'supercharger'}, snapshot.unpack(packed)[1])
+
+        self.db.suc.delete_one({'locationId': 'bern'})
+        self.db.suc.update_one({'locationId': 'zurich'}, {'$set': {'stalls': 12}})
+        self.assertEqual(2, snapshot.generate(self.db))
+
+        changes = snapshot.diff(self.db, 1, 2)
+        self.assertEqual(['zurich'], [r['locationId'] for r in changes['changed']])
+        self.assertEqual(12, changes['changed'][0]['stalls'])
+        self.assertEqual([{'type': 'supercharger', 'locationId': 'bern'}], changes['removed'])
+        self.assertIsNone(snapshot.diff(self.db, 0, 2))
+
+    def test_endpoints(self):
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        client = api.app.test_client()
+
+        response = client.get('/snapshot', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertEqual('1', response.headers['X-Snapshot-Version'])
+        self.assertEqual(3, json.loads(gzip.decompress(response.data).decode('utf-8'))['count'])
+        self.assertEqual(304, client.get('/snapshot', headers={'If-None-Match': response.headers['ETag']}).status_code)
+
+        response = client.get('/snapshot?version=1')
+        self.assertIsNone(response.headers.get('Content-Encoding'))
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(3, response.get_json()['count'])
+
+        self.db.suc.update_one({'locationId': 'zurich'}, {'$set': {'title': 'Zürich'}})
+        snapshot.generate(self.db)
+        response = client.get('/snapshot/diff?from=1')
+        self.assertEqual(['Zürich'], [r['title'] for r in response.get_json()['changed']])
+        self.assertEqual('2', response.headers['X-Snapshot-Version'])
+        self.assertEqual(404, client.get('/snapshot/diff?from=7').status_code)
+        self.assertEqual(404, client.get('/snapshot?version=7').status_code)
+
+
+class AssetsTest(unittest.TestCase):
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.target = tempfile.mkdtemp()
+        files = {
+            'index.html': '<script src="/static/app.js"></script><link href="/static/app.css"><script src="/config.js">',
+            'app.js': 'templateUrl: "/static/a.html", other: "/static/missing.html"',
+            'a.html': '<div ng-include="\'/static/b.html\'"></div>',
+            'b.html': '<p>' + 'padding ' * 100 + '</p>',
+            'app.css': 'body {}',
+            'notes.txt': '/static/app.js',
+        }
+        for name, text in files.items():
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(text)
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+        shutil.rmtree(self.target)
+        assets.reset()
+
+    def test_build(self):
+        manifest = assets.build(self.source, self.target)
+        self.assertEqual(['a.html', 'app.css', 'app.js', 'b.html'], sorted(manifest))
+        self.assertRegex(manifest['app.js'], r'^app\.[0-9a-f]{10}\.js$')
+
+        files = assets.load(self.target)
+        app_js = files[manifest['app.js']]['identity'].decode('utf-8')
+        self.assertIn('"/assets/%s"' % manifest['a.html'], app_js)
+        self.assertIn('"/static/missing.html"', app_js)
+        self.assertIn('/assets/%s' % manifest['b.html'], files[manifest['a.html']]['identity'].decode('utf-8'))
+        self.assertEqual('<script src="/assets/%s"></script><link href="/assets/%s"><script src="/config.js">'
+                         % (manifest['app.js'], manifest['app.css']), files['index.html']['identity'].decode('utf-8'))
+        self.assertEqual(files['index.html']['identity'], gzip.decompress(files['index.html']['gzip']))
+
+        # the same content gives the same names and bytes
+        self.assertEqual(manifest, assets.build(self.source, self.target))
+        self.assertEqual(files, assets.load(self.target))
+
+    def test_variant(self):
+        manifest = assets.build(self.source, self.target)
+        build_dir, assets.build_dir = assets.build_dir, self.target
+        try:
+            data, encoding = assets.variant(manifest['b.html'], Accept([('gzip', 1), ('deflate', 1)]))
+            self.assertEqual('gzip', encoding)
+            self.assertIn(b'padding', gzip.decompress(data))
+            self.assertEqual('identity', assets.variant(manifest['b.html'], Accept([]))[1])
+            # compressing does not pay off for tiny files
+            self.assertEqual((b'body {}', 'identity'), assets.variant(manifest['app.css'], Accept([('gzip', 1)])))
+            self.assertIsNone(assets.variant('app.js', Accept([])))
+        finally:
+            assets.build_dir = build_dir
+
+
+def plan_stages(plan):
+    """The stages of an explained query plan, of all its branches."""
+    if isinstance(plan, dict):
+        return ([plan['stage']] if 'stage' in plan else []) + [s for v in plan.values() for s in plan_stages(v)]
+    if isinstance(plan, list):
+        return [s for v in plan for s in plan_stages(v)]
+    return []
+
+
+class CheckinFilterTest(MongoTestCase):
+    def setUp(self):
+        super().setUp()
+        os.environ['MONGODB_URI'] = test_mongodb_uri
+        import api
+        self.api = api
+        self.client = api.app.test_client()
+        catalog.invalidate(self.db)
+        self.db.suc.insert_one(location_document(make_location('zurich', title='Zürich Hardturm'), 'supercharger'))
+        self.db.suc.insert_one(location_document(make_location('bern', title='Bern'), 'supercharger'))
+        now = tz_utc.localize(datetime.datetime.utcnow())
+        for i in range(3):
+            self.db.checkin.insert_one(make_submission('zurich', now - timedelta(hours=i), charging=i, title='Zurich'))
+            self.db.checkin.insert_one(make_submission('bern', now - timedelta(hours=i), charging=i))
+
+    def test_filter(self):
+        response = self.client.get('/checkin?limit=2&filter=zürich')
+        self.assertEqual([('zurich', 0), ('zurich', 1)],
+                         [(c['suc']['locationId'], c['checkin']['charging']) for c in response.get_json()])
+
+        response = self.client.get('/checkin?limit=2&filter=zürich&after=' + response.headers['X-Next-Cursor'])
+        self.assertEqual([2], [c['checkin']['charging'] for c in response.get_json()])
+        # matched against the catalog title, not the one stored with the checkin
+        self.assertEqual(3, len(self.client.get('/checkin?filter=hardturm').get_json()))
+        self.assertEqual([], self.client.get('/checkin?filter=basel').get_json())
+        self.assertEqual(6, len(self.client.get('/checkin').get_json()))
+
+    def test_explain(self):
+        query, hint = self.api.checkin_filter('hardturm')
+        plan = self.db.checkin.find(query).sort(self.api.checkin_sort).hint(hint).limit(50).explain()
+        stages = plan_stages(plan['queryPlanner']['winningPlan'])
+        self.assertIn('IXSCAN', stages)
+        self.assertNotIn('COLLSCAN', stages)
+        # the index gives the order, nothing is sorted in memory
+        self.assertNotIn('SORT', stages)